@@ -0,0 +1,48 @@
+"""
+Cold start benchmark.
+
+Measures, in a fresh interpreter, the time to import the server module, to run the startup hook (schema check)
+and to answer the first tool call through an in-process FastMCP client.
+
+    uv run python bench/bench_cold_start.py --runs 5
+"""
+import argparse,json,os,subprocess,sys
+
+MAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "main")
+
+PROBE = """
+import asyncio,json,sys,time
+started = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import main
+imported = time.perf_counter()
+from fastmcp import Client
+from migrations import migrate
+
+async def probe():
+    global migrated
+    await migrate()
+    migrated = time.perf_counter()
+    async with Client(main.mcp) as client:
+        await client.call_tool("get_budget_status", {})
+
+asyncio.run(probe())
+done = time.perf_counter()
+print(json.dumps({"import_ms": (imported - started) * 1000, "startup_ms": (migrated - imported) * 1000, "first_call_ms": (done - migrated) * 1000, "total_ms": (done - started) * 1000}))
+"""
+
+
+def main(runs:int):
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", PROBE, MAIN_DIR], capture_output=True, text=True, check=True).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    for key in samples[0]:
+        values = sorted(sample[key] for sample in samples)
+        print(f"{key:>14}: median {values[len(values) // 2]:8.1f} ms   min {values[0]:8.1f} ms   max {values[-1]:8.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    main(parser.parse_args().runs)
@@ -0,0 +1,116 @@
+"""
+Concurrency benchmark for the async tools.
+
+Runs the same mix of tool calls once serially and once from N parallel in-process FastMCP clients, then prints the
+throughput of both. --sync adds the same runs against the tools as they were before they became async: blocking
+functions that open a connection of their own per call and run the same queries without the result cache.
+
+    uv run python bench/bench_concurrency.py --clients 16 --requests 800 [--sync]
+"""
+import argparse,asyncio,os,sys,time
+from datetime import date
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "main"))
+
+import psycopg
+from fastmcp import Client,FastMCP
+from init_db import conn_kwargs
+from main import mcp,get_default_user_id
+
+CATEGORY = "misc" # From categories.json, add_expense rejects categories the user does not have
+
+async def seed(client:Client, count:int)-> list:
+    ids = []
+    for i in range(count):
+        result = await client.call_tool("add_expense", {"expense": {
+            "expense_date": date.today().isoformat(),
+            "original_amount": f"{10 + i}.00",
+            "category": CATEGORY,
+            "description": f"benchmark expense {i}",
+            "currency": "INR",
+        }})
+        ids.append(result.data["result"]["id"])
+    return ids
+
+
+async def one_call(client:Client, i:int, ids:list):
+    match i % 3:
+        case 0:
+            await client.call_tool("get_expense", {"expense_id": ids[i % len(ids)]})
+        case 1:
+            await client.call_tool("list_expenses", {"filters": {"category": CATEGORY, "start_date": date.today().isoformat()}})
+        case 2:
+            await client.call_tool("list_categories", {})
+
+
+def sync_server()-> FastMCP:
+    """The three tools of the mix the way they ran before: FastMCP calls a plain function on the event loop."""
+    server = FastMCP("expense-tracker-sync")
+    user_id = get_default_user_id()
+
+    def fetch(query:str, params:tuple)-> list:
+        with psycopg.connect(**conn_kwargs(), options=f"-c app.user_id={user_id}") as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, params)
+                return cur.fetchall()
+
+    @server.tool()
+    def get_expense(expense_id:int):
+        return fetch(
+            "SELECT expense_date,base_amount,original_amount, category,subcategory,description,currency,version,recurring_id FROM expenses WHERE user_id = %s AND id = %s",
+            (user_id, expense_id)
+        )
+
+    @server.tool()
+    def list_expenses(filters:dict):
+        return fetch(
+            """
+            SELECT id, expense_date, original_amount, base_amount, category, subcategory, description, currency, version, recurring_id
+            FROM expenses WHERE user_id = %s AND category = %s AND expense_date >= %s
+            ORDER BY expense_date DESC, base_amount DESC, id DESC LIMIT 101
+            """,
+            (user_id, filters["category"], filters["start_date"])
+        )
+
+    @server.tool()
+    def list_categories():
+        return fetch("SELECT category, NULLIF(subcategory, '') FROM user_categories WHERE user_id = %s ORDER BY category, subcategory", (user_id,))
+
+    return server
+
+
+async def run_client(server:FastMCP, requests:range, ids:list):
+    async with Client(server) as client:
+        for i in requests:
+            await one_call(client, i, ids)
+
+
+async def timed(server:FastMCP, clients:int, requests:int, ids:list)-> float:
+    started = time.perf_counter()
+    await asyncio.gather(*(run_client(server, range(c, requests, clients), ids) for c in range(clients)))
+    return time.perf_counter() - started
+
+
+async def main(clients:int, requests:int, seed_rows:int, sync:bool):
+    servers = [("async", mcp)] + ([("sync", sync_server())] if sync else [])
+    async with Client(mcp) as client:
+        ids = await seed(client, seed_rows)
+        print(f"requests: {requests}, parallel clients: {clients}")
+        for label, server in servers:
+            await timed(server, 1, 30, ids) # Warm up the pool and the caches
+            serial = await timed(server, 1, requests, ids)
+            parallel = await timed(server, clients, requests, ids)
+            print(f"{label} serial:   {serial:.3f}s  {requests / serial:.1f} req/s")
+            print(f"{label} parallel: {parallel:.3f}s  {requests / parallel:.1f} req/s  ({serial / parallel:.2f}x)")
+        for expense_id in ids:
+            await client.call_tool("delete_expense", {"expense_id": expense_id})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=800)
+    parser.add_argument("--seed-rows", type=int, default=50)
+    parser.add_argument("--sync", action="store_true", help="Also run the mix against blocking tools with a connection per call")
+    args = parser.parse_args()
+    asyncio.run(main(args.clients, args.requests, args.seed_rows, args.sync))
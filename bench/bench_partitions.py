@@ -0,0 +1,75 @@
+"""
+list_expenses latency on a large partitioned expenses table.
+
+Seeds --rows benchmark expenses spread over --years years for the default user with one INSERT ... SELECT
+generate_series per batch, then calls list_expenses through an in-process FastMCP client and prints the p50 and p95
+latency of a month range, a category with a quarter range, a year range and keyset paging through the newest rows.
+Seeded rows are kept for the next run, only the shortfall is inserted. --cleanup deletes them at the end.
+
+    uv run python bench/bench_partitions.py --rows 10000000 --iterations 50
+"""
+import argparse,asyncio,time
+from datetime import date,timedelta
+
+from common import seed,seeded_rows,cleanup,summarise
+
+from fastmcp import Client
+from main import mcp,get_default_user_id
+
+
+def scenarios(years:int)-> dict:
+    today = date.today()
+    month_start = (today.replace(day=1) - timedelta(days=1)).replace(day=1)
+    quarter_start = date(today.year - years // 2, 4, 1)
+    year_start = date(today.year - years // 2, 1, 1)
+    return {
+        "last month": {"start_date": month_start.isoformat(), "end_date": (today.replace(day=1) - timedelta(days=1)).isoformat()},
+        "category + quarter": {"category": "food", "start_date": quarter_start.isoformat(), "end_date": date(quarter_start.year, 6, 30).isoformat()},
+        "one year": {"start_date": year_start.isoformat(), "end_date": date(year_start.year, 12, 31).isoformat()},
+    }
+
+
+def report(name:str, timings:list):
+    stats = summarise(timings)
+    print(f"{name:<22} p50 {stats['p50_ms']:8.2f} ms   p95 {stats['p95_ms']:8.2f} ms   n {stats['count']}")
+
+
+async def main(rows:int, years:int, batch_size:int, iterations:int, pages:int, do_cleanup:bool):
+    async with Client(mcp) as client: # Runs the migrations before the first query
+        await seed(get_default_user_id(), rows, 1, years, batch_size)
+        print(f"benchmark rows: {await seeded_rows()}, years: {years}")
+        for name, filters in scenarios(years).items():
+            await client.call_tool("list_expenses", {"filters": filters, "limit": 100}) # Warm up
+            timings = []
+            for _ in range(iterations):
+                started = time.perf_counter()
+                await client.call_tool("list_expenses", {"filters": filters, "limit": 100})
+                timings.append(time.perf_counter() - started)
+            report(name, timings)
+
+        # Keyset paging from the newest row, every page seeks past the previous one
+        filters = {"start_date": (date.today() - timedelta(days=years * 365)).isoformat()}
+        timings = []
+        for _ in range(max(1, iterations // pages)):
+            cursor = None
+            for _ in range(pages):
+                started = time.perf_counter()
+                result = await client.call_tool("list_expenses", {"filters": filters, "limit": 100, "cursor": cursor})
+                timings.append(time.perf_counter() - started)
+                cursor = result.data["result"]["next_cursor"]
+        report(f"keyset {pages} pages", timings)
+
+        if do_cleanup:
+            print(f"deleted {await cleanup()} benchmark rows")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--years", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=1_000_000)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--cleanup", action="store_true", help="Delete the benchmark rows afterwards")
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.years, args.batch_size, args.iterations, args.pages, args.cleanup))
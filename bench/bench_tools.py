@@ -0,0 +1,224 @@
+"""
+Load test of the MCP tools.
+
+Seeds --rows benchmark expenses over --users users (10k to 10M rows, kept for later runs), points the rates API at a
+local stub and drives add_expense, list_expenses with several filters, update_expense, list_categories and
+get_expense through in-process FastMCP clients at the given concurrency. The tools act as the default user, which
+holds every users-th seeded row. Prints p50/p95/p99 latency per operation, throughput and memory, and saves them as
+JSON so runs before and after a change can be compared.
+
+    uv run python bench/bench_tools.py --rows 1000000 --users 50 --concurrency 16 --requests 5000
+    uv run python bench/bench_tools.py --rows 1000000 --users 50 --compare bench/results/before.json
+"""
+import argparse,asyncio,json,os,platform,random,resource,subprocess,sys,time
+from datetime import date,datetime,timedelta
+
+from common import MARKER,start_fx_stub,seed,seeded_rows,cleanup,summarise
+
+start_fx_stub() # Before main is imported, it reads the rates settings on import
+
+from fastmcp import Client
+from main import mcp,get_default_user_id
+from init_db import get_conn
+from migrations import CATEGORIES_PATH
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+SAMPLE_IDS = 2000
+
+
+class Workload:
+    """Picks the next operation and its arguments, every client has its own so runs are reproducible per seed."""
+
+    def __init__(self, rng:random.Random, categories:list, expense_ids:list, operations:list):
+        self.rng = rng
+        self.categories = categories
+        self.expense_ids = expense_ids
+        self.operations = operations
+        self.cursor = None
+        self.added = 0
+        today = date.today()
+        self.last_month_end = today.replace(day=1) - timedelta(days=1)
+        self.last_month_start = self.last_month_end.replace(day=1)
+
+    def next(self)-> tuple[str, str, dict]:
+        """(operation label, tool, arguments)"""
+        operation = self.rng.choice(self.operations)
+        today = date.today()
+        match operation:
+            case "add_expense":
+                self.added += 1
+                return operation, "add_expense", {"expense": {
+                    "expense_date": (today - timedelta(days=self.rng.randrange(365))).isoformat(),
+                    "original_amount": f"{self.rng.randrange(100, 100000) / 100:.2f}",
+                    "currency": self.rng.choice(["INR", "INR", "USD", "EUR"]),
+                    "category": self.rng.choice(self.categories),
+                    "description": f"{MARKER} added {self.added}",
+                }}
+            case "list_expenses:last_month":
+                return operation, "list_expenses", {"filters": {"start_date": self.last_month_start.isoformat(), "end_date": self.last_month_end.isoformat()}, "limit": 100}
+            case "list_expenses:category":
+                return operation, "list_expenses", {"filters": {"category": self.rng.choice(self.categories)}, "limit": 100}
+            case "list_expenses:category_quarter":
+                start = date(today.year - self.rng.randrange(1, 5), self.rng.choice([1, 4, 7, 10]), 1)
+                end = (start.replace(day=28) + timedelta(days=62)).replace(day=1) - timedelta(days=1)
+                return operation, "list_expenses", {"filters": {"category": self.rng.choice(self.categories), "start_date": start.isoformat(), "end_date": end.isoformat()}, "limit": 100}
+            case "list_expenses:amount_range":
+                low = self.rng.randrange(100, 4000)
+                return operation, "list_expenses", {"filters": {"min_amount": low, "max_amount": low + 50, "start_date": (today - timedelta(days=365)).isoformat()}, "limit": 100}
+            case "list_expenses:next_page":
+                # Follows the cursor of this client's previous page, starts over at the end
+                return operation, "list_expenses", {"filters": {"start_date": (today - timedelta(days=3650)).isoformat()}, "limit": 100, "cursor": self.cursor}
+            case "update_expense":
+                return operation, "update_expense", {"expense_id": self.rng.choice(self.expense_ids), "data": {"description": f"{MARKER} updated {self.rng.randrange(10**6)}"}}
+            case "list_categories":
+                return operation, "list_categories", {"usage": self.rng.random() < 0.5}
+            case "get_expense":
+                return operation, "get_expense", {"expense_id": self.rng.choice(self.expense_ids)}
+        raise ValueError(f"Unknown operation {operation}")
+
+
+OPERATIONS = [
+    "add_expense", "list_expenses:last_month", "list_expenses:category", "list_expenses:category_quarter",
+    "list_expenses:amount_range", "list_expenses:next_page", "update_expense", "list_categories", "get_expense",
+]
+
+
+async def sample_expense_ids()-> list:
+    async with get_conn(system=True) as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                "SELECT id FROM expenses WHERE user_id = %s AND description LIKE %s LIMIT %s",
+                (get_default_user_id(), f"{MARKER} %", SAMPLE_IDS)
+            )
+            return [row[0] for row in await cur.fetchall()]
+
+
+async def run_client(workload:Workload, requests:int, timings:dict, errors:dict):
+    async with Client(mcp) as client:
+        for _ in range(requests):
+            operation, tool, arguments = workload.next()
+            started = time.perf_counter()
+            try:
+                result = await client.call_tool(tool, arguments)
+            except Exception:
+                errors[operation] = errors.get(operation, 0) + 1
+                continue
+            timings.setdefault(operation, []).append(time.perf_counter() - started)
+            if operation == "list_expenses:next_page":
+                workload.cursor = result.data["result"]["next_cursor"]
+
+
+async def run_load(concurrency:int, requests:int, seed_value:int, operations:list, categories:list, expense_ids:list)-> tuple[dict, dict, float]:
+    timings, errors = {}, {}
+    workloads = [Workload(random.Random(seed_value + client), categories, expense_ids, operations) for client in range(concurrency)]
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        run_client(workload, requests // concurrency + (1 if client < requests % concurrency else 0), timings, errors)
+        for client, workload in enumerate(workloads)
+    ))
+    return timings, errors, time.perf_counter() - started
+
+
+def max_rss_mb()-> float:
+    # KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def git_commit()-> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report:dict, baseline:dict | None):
+    print(f"rows: {report['data']['rows']}, users: {report['data']['users']}, concurrency: {report['load']['concurrency']}, requests: {report['load']['requests']}")
+    header = f"{'operation':<32} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+    print(header + ("   p50 / p95 vs baseline" if baseline else ""))
+    for operation, stats in report["operations"].items():
+        line = f"{operation:<32} {stats['count']:>6} {stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f}"
+        before = (baseline or {}).get("operations", {}).get(operation)
+        if before:
+            line += f"   {change(before['p50_ms'], stats['p50_ms'])} / {change(before['p95_ms'], stats['p95_ms'])}"
+        print(line)
+    load = report["load"]
+    print(f"throughput: {load['throughput_rps']:.1f} req/s over {load['wall_s']:.2f}s, errors: {load['errors']}")
+    if baseline:
+        print(f"baseline throughput: {baseline['load']['throughput_rps']:.1f} req/s ({change(baseline['load']['throughput_rps'], load['throughput_rps'])})")
+    print(f"max rss: {report['memory']['max_rss_mb']} MB (before load {report['memory']['max_rss_before_load_mb']} MB)")
+
+
+def change(before:float, after:float)-> str:
+    return f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+
+
+async def main(args):
+    operations = [operation for operation in OPERATIONS if not args.only or operation.split(":")[0] in args.only or operation in args.only]
+    if not operations:
+        raise SystemExit(f"--only matched no operation, choose from {', '.join(OPERATIONS)}")
+    with open(CATEGORIES_PATH, "r", encoding="utf-8") as f:
+        categories = list(json.load(f))
+
+    # The outer client holds the server lifespan (migrations, pool) open, the load clients join it
+    async with Client(mcp):
+        seed_seconds = await seed(get_default_user_id(), args.rows, args.users, args.years, args.batch_size)
+        rows = await seeded_rows()
+        expense_ids = await sample_expense_ids()
+
+        await run_load(min(args.concurrency, args.warmup) or 1, args.warmup, args.seed + 10_000, operations, categories, expense_ids)
+        rss_before = max_rss_mb()
+        timings, errors, wall = await run_load(args.concurrency, args.requests, args.seed, operations, categories, expense_ids)
+
+        if args.cleanup:
+            print(f"deleted {await cleanup()} benchmark rows")
+
+    completed = sum(len(values) for values in timings.values())
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "data": {"rows": rows, "users": args.users, "seed_s": round(seed_seconds, 2)},
+        "load": {
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "completed": completed,
+            "errors": sum(errors.values()),
+            "wall_s": round(wall, 3),
+            "throughput_rps": round(completed / wall, 2),
+        },
+        "operations": {operation: {**summarise(timings[operation]), "errors": errors.get(operation, 0)} for operation in operations if operation in timings},
+        "memory": {"max_rss_mb": max_rss_mb(), "max_rss_before_load_mb": rss_before},
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    out = args.out or os.path.join(RESULTS_DIR, f"tools-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"saved {out}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100_000, help="Benchmark expenses to seed across all users")
+    parser.add_argument("--users", type=int, default=10, help="Users the rows are spread over, the tools act as the first")
+    parser.add_argument("--years", type=int, default=5, help="Years back the seeded expense dates reach")
+    parser.add_argument("--batch-size", type=int, default=1_000_000, help="Rows inserted per seeding statement")
+    parser.add_argument("--concurrency", type=int, default=8, help="Parallel in-process clients")
+    parser.add_argument("--requests", type=int, default=2000, help="Measured tool calls across all clients")
+    parser.add_argument("--warmup", type=int, default=100, help="Unmeasured tool calls before the measured ones")
+    parser.add_argument("--only", nargs="+", help="Operations or tools to run, e.g. get_expense list_expenses:category")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed of the workload")
+    parser.add_argument("--out", help="Result file, bench/results/tools-<timestamp>.json by default")
+    parser.add_argument("--compare", help="Earlier result file to compare against")
+    parser.add_argument("--cleanup", action="store_true", help="Delete the benchmark rows and users afterwards")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,135 @@
+"""
+Shared parts of the benchmarks: seeding expenses in bulk, a local stub of the rates API and latency statistics.
+
+Seeded rows carry a description starting with MARKER so later runs reuse them and cleanup() finds them. Extra users
+are created with an email starting with BENCH_USER_PREFIX and are removed by cleanup() together with their expenses.
+"""
+import hashlib,json,math,os,statistics,sys,tempfile,threading,time,uuid
+from http.server import BaseHTTPRequestHandler,ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "main"))
+
+from init_db import get_conn
+from migrations import CATEGORIES_PATH
+
+MARKER = "benchmark row"
+BENCH_USER_PREFIX = "bench-user-"
+
+# 1 USD = rate currency, close enough to real rates for the amounts to look plausible
+STUB_RATES = {
+    "USD": 1, "INR": 83.2, "AED": 3.67, "CAD": 1.36, "EUR": 0.92, "MYR": 4.7, "SEK": 10.5, "AUD": 1.52, "CHF": 0.88, "GBP": 0.79,
+    "JPY": 151.0, "PHP": 56.1, "SGD": 1.34, "ZAR": 18.6, "BRL": 5.0, "CNY": 7.2, "HKD": 7.8, "MXN": 16.9, "SAR": 3.75, "THB": 36.4,
+}
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        base = self.path.rstrip("/").rsplit("/", 1)[-1].upper()
+        if base not in STUB_RATES:
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = json.dumps({"result": "success", "base_code": base, "rates": {currency: rate / STUB_RATES[base] for currency, rate in STUB_RATES.items()}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_fx_stub()-> str:
+    """
+    Serve the rates API from a local thread and point the server at it. Call it before importing main, the rates
+    settings are read on import. The rate cache goes to a temporary file so the real one is left alone.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ["FX_API_URL"] = url
+    os.environ["FX_CACHE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="expense-bench-"), "fx_rates_cache.json")
+    return url
+
+
+def bench_users(users:int)-> list:
+    """(id, email) of users-1 extra benchmark users, the ids derive from the emails so reruns find the same users."""
+    emails = [f"{BENCH_USER_PREFIX}{i}@bench.example.com" for i in range(1, users)]
+    return [(str(uuid.UUID(hashlib.md5(email.encode()).hexdigest())), email) for email in emails]
+
+
+async def seeded_rows()-> int:
+    async with get_conn(system=True) as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT COUNT(*) FROM expenses WHERE description LIKE %s", (f"{MARKER} %",))
+            return (await cur.fetchone())[0]
+
+
+async def seed(default_user_id:str, rows:int, users:int = 1, years:int = 10, batch_size:int = 1_000_000)-> float:
+    """
+    Make sure rows benchmark expenses exist, spread round robin over the users and over the last years years.
+    Only the shortfall is inserted, one INSERT ... SELECT generate_series per batch so the rollup and category
+    triggers run once per batch. Returns the seconds spent.
+    """
+    started = time.perf_counter()
+    with open(CATEGORIES_PATH, "r", encoding="utf-8") as f:
+        categories = list(json.load(f))
+    async with get_conn(system=True) as conn:
+        async with conn.cursor() as cur:
+            extra_users = bench_users(users)
+            await cur.execute(
+                "INSERT INTO users (id, email) SELECT * FROM unnest(%s::uuid[], %s::text[]) ON CONFLICT (id) DO NOTHING",
+                ([user_id for user_id, _ in extra_users], [email for _, email in extra_users])
+            )
+            # Backdated rows would otherwise fill the default partition until the next startup splits it
+            await cur.execute("SELECT ensure_expense_partitions(CURRENT_DATE - %s, CURRENT_DATE)", (years * 365,))
+
+    # The tools act as the default user, it gets every users-th row
+    user_ids = [default_user_id] + [user_id for user_id, _ in extra_users]
+    existing = await seeded_rows()
+    for start in range(existing, rows, batch_size):
+        end = min(start + batch_size, rows) - 1
+        batch_started = time.perf_counter()
+        async with get_conn(system=True) as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    """
+                    INSERT INTO expenses (user_id, expense_date, original_amount, currency, base_amount, category, description)
+                    SELECT (%s::uuid[])[1 + i %% %s], CURRENT_DATE - (i * 7919 %% %s)::int, 1 + (i * 37 %% 500000) / 100.0, 'INR',
+                           1 + (i * 37 %% 500000) / 100.0, (%s::text[])[1 + i %% %s], %s || ' ' || i
+                    FROM generate_series(%s::bigint, %s::bigint) AS i
+                    """,
+                    (user_ids, len(user_ids), years * 365, categories, len(categories), MARKER, start, end)
+                )
+            await conn.execute("ANALYZE expenses")
+        print(f"seeded {end + 1}/{rows} rows in {time.perf_counter() - batch_started:.1f}s", file=sys.stderr, flush=True)
+    return time.perf_counter() - started
+
+
+async def cleanup()-> int:
+    """Delete the benchmark rows and users, returns the number of expenses deleted."""
+    async with get_conn(system=True) as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("DELETE FROM expenses WHERE description LIKE %s", (f"{MARKER} %",))
+            deleted = cur.rowcount
+            await cur.execute("DELETE FROM users WHERE email LIKE %s", (f"{BENCH_USER_PREFIX}%",))
+    return deleted
+
+
+def percentile(values:list, p:float)-> float:
+    """Nearest rank percentile of sorted values."""
+    return values[max(0, math.ceil(len(values) * p / 100) - 1)]
+
+
+def summarise(timings:list)-> dict:
+    """Latency statistics in milliseconds of a list of durations in seconds."""
+    timings = sorted(timings)
+    return {
+        "count": len(timings),
+        "p50_ms": round(percentile(timings, 50) * 1000, 3),
+        "p95_ms": round(percentile(timings, 95) * 1000, 3),
+        "p99_ms": round(percentile(timings, 99) * 1000, 3),
+        "mean_ms": round(statistics.fmean(timings) * 1000, 3),
+        "max_ms": round(timings[-1] * 1000, 3),
+    }
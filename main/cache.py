@@ -0,0 +1,88 @@
+import os,time
+from collections import OrderedDict
+
+# Read-through cache of tool results per user, bounded by RESULT_CACHE_SIZE entries and RESULT_CACHE_TTL seconds.
+# Writes made by this process invalidate the affected entries right away, the TTL bounds how long writes from other
+# processes (e.g. the command line) can go unseen. RESULT_CACHE_SIZE=0 turns the cache off.
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "1024"))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "60"))
+
+
+class ResultCache:
+    """LRU cache of results keyed by (user, namespace, key) with per key and per namespace invalidation."""
+
+    def __init__(self, max_entries:int = RESULT_CACHE_SIZE, ttl:float = RESULT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict() # (user_id, namespace, key) -> (expires_at, value)
+        self._namespaces = {} # (user_id, namespace) -> set of its entry keys, so a namespace is dropped without a scan
+        self._epochs = {} # user_id -> number of invalidations, see get_or_load
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def _drop(self, entry_key:tuple):
+        self._entries.pop(entry_key, None)
+        keys = self._namespaces.get(entry_key[:2])
+        if keys is not None:
+            keys.discard(entry_key)
+            if not keys:
+                del self._namespaces[entry_key[:2]]
+
+    def get(self, user_id:str, namespace:str, key):
+        """Cached value or None."""
+        entry_key = (user_id, namespace, key)
+        entry = self._entries.get(entry_key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._drop(entry_key)
+            self._stats["misses"] += 1
+            return None
+        self._entries.move_to_end(entry_key)
+        self._stats["hits"] += 1
+        return entry[1]
+
+    def put(self, user_id:str, namespace:str, key, value):
+        if self.max_entries <= 0:
+            return
+        entry_key = (user_id, namespace, key)
+        self._entries[entry_key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(entry_key)
+        self._namespaces.setdefault((user_id, namespace), set()).add(entry_key)
+        while len(self._entries) > self.max_entries:
+            # Least recently used first
+            self._drop(next(iter(self._entries)))
+            self._stats["evictions"] += 1
+
+    async def get_or_load(self, user_id:str, namespace:str, key, load):
+        """Return the cached value or await load() and cache its result."""
+        value = self.get(user_id, namespace, key)
+        if value is not None:
+            return value
+        # A write that lands while load() runs may make its result stale, it is only cached when nothing was invalidated meanwhile
+        epoch = self._epochs.get(user_id, 0)
+        value = await load()
+        if value is not None and self._epochs.get(user_id, 0) == epoch:
+            self.put(user_id, namespace, key, value)
+        return value
+
+    def invalidate(self, user_id:str, namespace:str, key = None):
+        """Drop one key, or the whole namespace of the user when key is None."""
+        self._stats["invalidations"] += 1
+        self._epochs[user_id] = self._epochs.get(user_id, 0) + 1
+        if key is None:
+            for entry_key in self._namespaces.pop((user_id, namespace), ()):
+                del self._entries[entry_key]
+        else:
+            self._drop((user_id, namespace, key))
+
+    def stats(self)-> dict:
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            **self._stats,
+            "hit_rate": round(self._stats["hits"] / lookups, 4) if lookups else 0.0,
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+        }
+
+
+result_cache = ResultCache()
@@ -0,0 +1,144 @@
+"""
+Command line entry points for work that does not fit a single tool call.
+
+    uv run python main/cli.py migrate [--status]
+    uv run python main/cli.py import-csv statement.csv [--skip-invalid] [--user subject]
+    uv run python main/cli.py seed-rates rates.csv [--base USD] | --live [--base USD]
+    uv run python main/cli.py recompute-base [--chunk-size 5000]
+    uv run python main/cli.py export [--format csv|jsonl|parquet] [--out path] [--user subject] [--period last_fy | --start-date 2025-04-01 ...]
+    uv run python main/cli.py materialise-recurring
+"""
+import argparse,asyncio,csv,json,sys
+from datetime import date
+from decimal import Decimal,InvalidOperation
+from pydantic import ValidationError
+from init_db import get_conn,close_pool
+from fx import rate_cache,store_rates,FX_PIVOT
+from main import AddExpenseSchema,FiltersSchema,insert_expenses_bulk,recompute_base_amounts,export_expenses_to_file,materialise_recurring_expenses,resolve_user,acting_user,AUTO_MIGRATE,RECOMPUTE_CHUNK_SIZE
+from migrations import migrate,current_version,LATEST_VERSION
+
+
+def read_expenses_csv(path:str):
+    """Parse a CSV with the AddExpenseSchema columns as header, returns (expenses, row_errors)."""
+    expenses = []
+    errors = []
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        for row, fields in enumerate(csv.DictReader(f)):
+            # Empty cells mean the optional field is not set
+            fields = {key.strip(): value.strip() for key, value in fields.items() if key and value and value.strip()}
+            try:
+                expenses.append(AddExpenseSchema.model_validate(fields))
+            except ValidationError as e:
+                expenses.append(None)
+                errors.append({"row": row, "error": "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())})
+    return expenses, errors
+
+
+async def run(job, migrate_first:bool = AUTO_MIGRATE):
+    """Run a coroutine the way the server would: schema checked first, pool and HTTP client closed at the end."""
+    try:
+        if migrate_first:
+            await migrate()
+        return await job
+    finally:
+        await rate_cache.aclose()
+        await close_pool()
+
+
+async def as_user(external_id:str | None, job):
+    """Run a tool level job for the user with this token subject, the local user without one."""
+    if external_id:
+        acting_user.set(await resolve_user(external_id))
+    return await job
+
+
+async def schema_status()-> dict:
+    async with get_conn(system=True) as conn:
+        version = await current_version(conn)
+    return {"version": version, "latest_version": LATEST_VERSION, "pending": LATEST_VERSION - version}
+
+
+async def import_csv(path:str, skip_invalid:bool):
+    expenses, errors = read_expenses_csv(path)
+    return await insert_expenses_bulk(expenses, skip_invalid, errors)
+
+
+def read_rates_csv(path:str)-> dict:
+    """Parse a CSV with a date,currency,rate header into {date: {currency: rate}}."""
+    tables = {}
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        for row, fields in enumerate(csv.DictReader(f)):
+            try:
+                rate = Decimal(fields["rate"].strip())
+                if rate <= 0:
+                    raise ValueError("rate must be positive")
+                tables.setdefault(date.fromisoformat(fields["date"].strip()), {})[fields["currency"].strip().upper()] = rate
+            except (KeyError, AttributeError, ValueError, InvalidOperation) as e:
+                raise ValueError(f"Invalid rate on row {row}: {e}") from e
+    return tables
+
+
+async def seed_rates(path:str | None, base:str)-> dict:
+    """Load historical rates from a file, or today's live table when no file is given, into fx_rates."""
+    tables = read_rates_csv(path) if path else {date.today(): await rate_cache.get_rates(base)}
+    written = 0
+    # One transaction for the whole file
+    async with get_conn(system=True) as conn:
+        for rate_date, rates in sorted(tables.items()):
+            written += await store_rates(conn, rate_date, base, rates)
+    return {"days": len(tables), "rates": written}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Expense Tracker command line")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = commands.add_parser("migrate", help="Apply pending schema migrations")
+    migrate_parser.add_argument("--status", action="store_true", help="Only report the current and latest schema version")
+
+    import_parser = commands.add_parser("import-csv", help="Bulk load expenses from a CSV file in one transaction")
+    import_parser.add_argument("path", help="CSV with a header of expense_date,original_amount,currency,category,subcategory,description")
+    import_parser.add_argument("--skip-invalid", action="store_true", help="Load the valid rows even when some rows are invalid")
+    import_parser.add_argument("--user", help="Token subject of the user to import for with MULTI_USER, created if new")
+
+    rates_parser = commands.add_parser("seed-rates", help="Load historical currency rates into the fx_rates table")
+    rates_source = rates_parser.add_mutually_exclusive_group(required=True)
+    rates_source.add_argument("path", nargs="?", help="CSV with a header of date,currency,rate where 1 base = rate currency")
+    rates_source.add_argument("--live", action="store_true", help="Store today's table from FX_API_URL instead of a file")
+    rates_parser.add_argument("--base", default=FX_PIVOT, help=f"Base currency of the rates (default {FX_PIVOT})")
+
+    recompute_parser = commands.add_parser("recompute-base", help="Recompute base amounts in BASE_CURRENCY from the stored rate history")
+    recompute_parser.add_argument("--chunk-size", type=int, default=RECOMPUTE_CHUNK_SIZE, help="Rows updated per transaction")
+
+    export_parser = commands.add_parser("export", help="Stream the expenses matching the filters to a CSV, JSONL or Parquet file")
+    export_parser.add_argument("--format", choices=["csv", "jsonl", "parquet"], default="csv")
+    export_parser.add_argument("--out", help="Output file, a new file in EXPORT_DIR by default")
+    export_parser.add_argument("--user", help="Token subject of the user to export with MULTI_USER")
+    for field in ["category", "subcategory", "start_date", "end_date", "period", "currency"]:
+        export_parser.add_argument(f"--{field.replace('_', '-')}", dest=field)
+
+    commands.add_parser("materialise-recurring", help="Add the due occurrences of every recurring expense, e.g. from cron with RECURRING_INTERVAL=0")
+
+    args = parser.parse_args()
+    if args.command == "migrate":
+        job = schema_status() if args.status else migrate()
+        print(json.dumps(asyncio.run(run(job, migrate_first=False)), indent=2))
+    elif args.command == "import-csv":
+        response = asyncio.run(run(as_user(args.user, import_csv(args.path, args.skip_invalid))))
+        result = response["result"]
+        print(json.dumps({"status": response["status"], "inserted": result["inserted"], "errors": result["errors"]}, indent=2))
+        if response["status"] != "success":
+            sys.exit(1)
+    elif args.command == "seed-rates":
+        print(json.dumps(asyncio.run(run(seed_rates(args.path, args.base.upper()))), indent=2))
+    elif args.command == "recompute-base":
+        print(json.dumps(asyncio.run(run(recompute_base_amounts(args.chunk_size)))["result"], indent=2))
+    elif args.command == "export":
+        filters = FiltersSchema(category=args.category, subcategory=args.subcategory, start_date=args.start_date, end_date=args.end_date, period=args.period, currency=args.currency)
+        print(json.dumps(asyncio.run(run(as_user(args.user, export_expenses_to_file(filters, args.format, args.out)))), indent=2))
+    elif args.command == "materialise-recurring":
+        print(json.dumps(asyncio.run(run(materialise_recurring_expenses()))["result"], indent=2))
+
+
+if __name__ == "__main__":
+    main()
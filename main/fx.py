@@ -0,0 +1,228 @@
+import json,os,sys,asyncio,time,tempfile
+from datetime import date
+from decimal import Decimal
+import httpx
+from init_db import get_conn
+from metrics import stage
+
+# Rates are fetched as whole tables (1 base = x target) and served from memory until they are older than FX_CACHE_TTL.
+# The last good tables are also written to FX_CACHE_PATH so a restart or an outage of the rates API can still convert.
+FX_API_URL = os.getenv("FX_API_URL", "https://open.er-api.com/v6/latest")
+FX_CACHE_TTL = float(os.getenv("FX_CACHE_TTL", "3600"))
+FX_CACHE_PATH = os.getenv("FX_CACHE_PATH", os.path.join(os.path.dirname(__file__), "fx_rates_cache.json"))
+
+# Historical rates live in the fx_rates table as 1 FX_PIVOT = rate currency, the rate between any two currencies on a
+# day is the ratio of their rows. A day without a row uses the latest earlier row up to FX_HISTORY_MAX_AGE_DAYS old.
+FX_PIVOT = "USD"
+FX_HISTORY_MAX_AGE = int(os.getenv("FX_HISTORY_MAX_AGE_DAYS", "7"))
+
+
+class RateCache:
+    """In memory cache of rate tables keyed by base currency with a disk copy of the last good tables."""
+
+    def __init__(self, api_url:str = FX_API_URL, ttl:float = FX_CACHE_TTL, path:str | None = FX_CACHE_PATH, on_fetch = None):
+        self.api_url = api_url.rstrip("/")
+        self.ttl = ttl
+        self.path = path
+        self.on_fetch = on_fetch # async (base, table), called after every successful fetch
+        self._tables = {} # base -> {"fetched_at": epoch seconds, "rates": {currency: rate}}
+        self._loaded = False
+        self._fetch_locks = {}
+        self._client = None
+        self._stats = {"hits": 0, "misses": 0, "fetches": 0, "fetch_errors": 0, "stale_served": 0}
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._tables.update(json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable rate cache {self.path}: {e}", file=sys.stderr)
+
+    def _save(self, snapshot:str):
+        try:
+            with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp", delete=False) as f:
+                f.write(snapshot)
+            os.replace(f.name, self.path) # Atomic so a crash never leaves a half written cache
+        except OSError as e:
+            print(f"Could not persist rate cache to {self.path}: {e}", file=sys.stderr)
+
+    def _fresh(self, base:str):
+        table = self._tables.get(base)
+        if table and time.time() - table["fetched_at"] < self.ttl:
+            return table
+        return None
+
+    async def _fetch(self, base:str)-> dict:
+        self._stats["fetches"] += 1
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=5)
+        try:
+            with stage("fx"):
+                response = await self._client.get(f"{self.api_url}/{base}")
+        except httpx.HTTPError as e:
+            raise RuntimeError("Request Failed") from e
+        if response.status_code != 200:
+            raise RuntimeError("Bad Request")
+        data = response.json()
+        if not isinstance(data.get("rates"), dict):
+            raise RuntimeError("Rates missing from the response")
+        return {"fetched_at": time.time(), "rates": data["rates"]}
+
+    async def get_rates(self, base:str)-> dict:
+        """Return the rate table for base, fetching it only when the cached copy has expired."""
+        self._load()
+        table = self._fresh(base)
+        if table:
+            self._stats["hits"] += 1
+            return table["rates"]
+        self._stats["misses"] += 1
+
+        # Only one task fetches a given base, the others wait and reuse its result
+        fetch_lock = self._fetch_locks.setdefault(base, asyncio.Lock())
+        async with fetch_lock:
+            table = self._fresh(base)
+            if table:
+                return table["rates"]
+            try:
+                table = await self._fetch(base)
+            except Exception:
+                self._stats["fetch_errors"] += 1
+                stale = self._tables.get(base)
+                if stale:
+                    # Offline fallback to the last good table however old it is
+                    self._stats["stale_served"] += 1
+                    return stale["rates"]
+                raise
+            self._tables[base] = table
+            if self.path:
+                await asyncio.to_thread(self._save, json.dumps(self._tables))
+            if self.on_fetch:
+                try:
+                    await self.on_fetch(base, table)
+                except Exception as e:
+                    print(f"Could not record fetched {base} rates: {e}", file=sys.stderr)
+            return table["rates"]
+
+    async def get_rate(self, from_currency:str, to_currency:str)-> Decimal:
+        """Rate to multiply an amount in from_currency with to get to_currency."""
+        if from_currency == to_currency:
+            return Decimal(1)
+        self._load()
+        if not self._fresh(from_currency):
+            # The table of to_currency has the rate of every currency into it inverted, converting many currencies to
+            # the base currency costs one fetch instead of one per source currency
+            try:
+                inverse = await self.get_rates(to_currency)
+            except Exception:
+                inverse = {}
+            if inverse.get(from_currency):
+                return Decimal(1) / Decimal(str(inverse[from_currency]))
+        rates = await self.get_rates(from_currency)
+        try:
+            return Decimal(str(rates[to_currency]))
+        except KeyError:
+            raise KeyError(f"Currency rate for {to_currency} not found")
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self)-> dict:
+        now = time.time()
+        return {
+            **self._stats,
+            "ttl": self.ttl,
+            "tables": {
+                base: {"age_seconds": round(now - table["fetched_at"], 3), "fresh": now - table["fetched_at"] < self.ttl}
+                for base, table in self._tables.items()
+            },
+        }
+
+
+def pivot_rates(base:str, rates:dict)-> dict:
+    """Re-express a table of 1 base = rate currency against FX_PIVOT."""
+    rates = {currency: Decimal(str(rate)) for currency, rate in rates.items()}
+    rates[base] = Decimal(1)
+    if base != FX_PIVOT:
+        if FX_PIVOT not in rates:
+            raise ValueError(f"Rate table for {base} has no {FX_PIVOT} rate")
+        pivot = rates[FX_PIVOT]
+        rates = {currency: rate / pivot for currency, rate in rates.items()}
+    return rates
+
+
+async def store_rates(conn, rate_date:date, base:str, rates:dict)-> int:
+    """Upsert one day of rates given as 1 base = rate currency, returns the number of currencies written."""
+    rates = pivot_rates(base, rates)
+    await conn.execute(
+        """
+        INSERT INTO fx_rates (currency, rate_date, rate)
+        SELECT currency, %s, rate FROM unnest(%s::text[], %s::numeric[]) AS t(currency, rate)
+        ON CONFLICT (currency, rate_date) DO UPDATE SET rate = EXCLUDED.rate
+        """,
+        (rate_date, list(rates), list(rates.values()))
+    )
+    return len(rates)
+
+
+async def _store_live_table(base:str, table:dict):
+    # Live tables become the history of the day they were fetched, so today's conversions can be recomputed later
+    async with get_conn(system=True) as conn:
+        await store_rates(conn, date.fromtimestamp(table["fetched_at"]), base, table["rates"])
+
+
+async def get_rates_on(keys:set, to_currency:str)-> dict:
+    """
+    Rate to multiply an amount with to get to_currency for every (date, currency) in keys.
+
+    Past dates are looked up in fx_rates in one query, today's date and pairs missing from the history use the live rates.
+    """
+    rates = {}
+    today = date.today()
+    history = {(on_date, currency) for on_date, currency in keys if currency != to_currency and on_date < today}
+    if history:
+        dates = sorted({on_date for on_date, _ in history})
+        pairs = history | {(on_date, to_currency) for on_date in dates}
+        async with get_conn(system=True) as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    """
+                    SELECT p.rate_date, p.currency, r.rate
+                    FROM unnest(%s::date[], %s::text[]) AS p(rate_date, currency)
+                    CROSS JOIN LATERAL (
+                        SELECT rate FROM fx_rates
+                        WHERE currency = p.currency AND rate_date <= p.rate_date AND rate_date > p.rate_date - %s
+                        ORDER BY rate_date DESC LIMIT 1
+                    ) r
+                    """,
+                    ([on_date for on_date, _ in pairs], [currency for _, currency in pairs], FX_HISTORY_MAX_AGE)
+                )
+                pivot = {(on_date, currency): rate for on_date, currency, rate in await cur.fetchall()}
+        for on_date, currency in history:
+            if (on_date, currency) in pivot and (on_date, to_currency) in pivot:
+                rates[(on_date, currency)] = pivot[(on_date, to_currency)] / pivot[(on_date, currency)]
+
+    # One live lookup per currency for everything the history could not answer
+    missing = sorted({currency for on_date, currency in keys if (on_date, currency) not in rates and currency != to_currency})
+    live = dict(zip(missing, await asyncio.gather(*(rate_cache.get_rate(currency, to_currency) for currency in missing))))
+    for on_date, currency in keys:
+        if currency == to_currency:
+            rates[(on_date, currency)] = Decimal(1)
+        elif (on_date, currency) not in rates:
+            rates[(on_date, currency)] = live[currency]
+    return rates
+
+
+async def get_rate_on(from_currency:str, to_currency:str, on_date:date | None = None)-> Decimal:
+    """Rate from from_currency to to_currency on on_date, the latest live rate when on_date is not given."""
+    on_date = on_date or date.today()
+    return (await get_rates_on({(on_date, from_currency)}, to_currency))[(on_date, from_currency)]
+
+
+rate_cache = RateCache(on_fetch=_store_live_table)
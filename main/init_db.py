@@ -1,79 +1,132 @@
-import psycopg2,sys,os
+import sys,os,asyncio,time,weakref
+from contextlib import asynccontextmanager
+from psycopg_pool import AsyncConnectionPool
 from dotenv import load_dotenv
+from metrics import configure_connection,observe_stage,METRICS_ENABLED
 
 load_dotenv()
 
 # For this to work each user has to configure the Postgres on their machine.
 # Better to ship a Docker container with PostgreSQL and your MCP server preconfigured.
 
-def get_conn():
-    try:
-        conn = psycopg2.connect(
-            dbname=os.getenv("DB_NAME"),
-            user=os.getenv("DB_USER"), 
-            password=os.getenv("DB_PASSWORD"),
-            host=os.getenv("DB_HOST", "localhost"),
-            port=int(os.getenv("DB_PORT", "5432"))
-        )
-        print("Database connection successful", file=sys.stderr)
-        return conn
-    except Exception as e:
-        print(f"Database connection failed: {e}", file=sys.stderr)
-        raise RuntimeError(f"Database connection failed: {e}")
+def conn_kwargs()-> dict:
+    return {
+        "dbname": os.getenv("DB_NAME"),
+        "user": os.getenv("DB_USER"),
+        "password": os.getenv("DB_PASSWORD"),
+        "host": os.getenv("DB_HOST", "localhost"),
+        "port": int(os.getenv("DB_PORT", "5432")),
+    }
+
+HEALTH_CHECK_INTERVAL = float(os.getenv("DB_POOL_HEALTH_CHECK_INTERVAL", "30"))
 
-def init_schema():
+_last_used = weakref.WeakKeyDictionary() # connection -> monotonic time it was last returned to the pool
+_health_check_failures = 0
+
+async def _check(conn):
+    # Ping only connections that sat idle for a while, recently used ones are trusted to save a round trip
+    global _health_check_failures
+    if time.monotonic() - _last_used.get(conn, 0) < HEALTH_CHECK_INTERVAL:
+        return
     try:
-        with get_conn() as conn:
-            with conn.cursor() as cur:
-                    
-                # Users table
-                cur.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id UUID PRIMARY KEY,
-                    email TEXT NOT NULL UNIQUE CHECK (email ~* '^[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\\.[A-Za-z]{2,}$'),
-                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-                );
-                """)
+        # In autocommit like psycopg_pool's own check, the connection is handed out idle
+        await conn.set_autocommit(True)
+        await conn.execute("SELECT 1")
+        await conn.set_autocommit(False)
+    except Exception:
+        _health_check_failures += 1
+        raise
+
+async def _reset(conn):
+    _last_used[conn] = time.monotonic()
 
-                # Initialize Local User
-                cur.execute("""
-                    INSERT INTO users (id, email)
-                    VALUES (
-                        '00000000-0000-0000-0000-000000000001',
-                        'local@expense.tracker'
-                    )
-                    ON CONFLICT (id) DO NOTHING;
-                """)
+async def _reconnect_failed(pool):
+    print("Database connection failed: could not reconnect to the database", file=sys.stderr)
 
-                # Expenses table
-                cur.execute("""
-                CREATE TABLE IF NOT EXISTS expenses (
-                    id SERIAL PRIMARY KEY,
-                    user_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-                    expense_date DATE NOT NULL,
-                    original_amount NUMERIC(10,2) NOT NULL CHECK (original_amount > 0),
-                    currency CHAR(3) NOT NULL,
-                    base_amount NUMERIC(10,2) NOT NULL CHECK (base_amount > 0),
-                    category TEXT NOT NULL,
-                    subcategory TEXT,
-                    description TEXT,
-                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()              
-                );
-                """)
+_pool = None
+_pool_lock = asyncio.Lock()
 
-                # Index for faster queries
-                cur.execute("""     
-                CREATE INDEX IF NOT EXISTS idx_expenses_user_category
-                ON expenses (user_id, category);
-                            
-                CREATE INDEX IF NOT EXISTS idx_expenses_user_date
-                ON expenses (user_id, expense_date);
-                            
-                CREATE INDEX IF NOT EXISTS idx_expenses_user_date_category
-                ON expenses (user_id, expense_date, category);
-                """)
+async def get_pool()-> AsyncConnectionPool:
+    """Open the shared async pool on first use so it is bound to the running event loop."""
+    global _pool
+    if _pool is None:
+        async with _pool_lock:
+            if _pool is None:
+                pool = AsyncConnectionPool(
+                    kwargs=conn_kwargs(),
+                    min_size=int(os.getenv("DB_POOL_MIN_SIZE", "1")),
+                    max_size=int(os.getenv("DB_POOL_MAX_SIZE", "10")),
+                    max_idle=float(os.getenv("DB_POOL_IDLE_TIMEOUT", "300")),
+                    timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
+                    check=_check,
+                    reset=_reset,
+                    reconnect_failed=_reconnect_failed,
+                    configure=configure_connection if METRICS_ENABLED else None,
+                    open=False,
+                )
+                try:
+                    await pool.open(wait=True, timeout=pool.timeout)
+                except Exception as e:
+                    await pool.close()
+                    print(f"Database connection failed: {e}", file=sys.stderr)
+                    raise RuntimeError(f"Database connection failed: {e}")
+                print("Database connection successful", file=sys.stderr)
+                _pool = pool
+    return _pool
 
-                print("Schema initialized successfully.")
-    except Exception as e:
-        raise RuntimeError("Runtime Error on creating schema") from e # From e means When e occurs raise RuntimeError()
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+def pool_stats()-> dict:
+    if _pool is None:
+        return {"open_connections": 0}
+    stats = _pool.get_stats()
+    return {
+        "checkouts": stats.get("requests_num", 0),
+        "waits": stats.get("requests_queued", 0),
+        "wait_time": stats.get("requests_wait_ms", 0) / 1000,
+        "timeouts": stats.get("requests_errors", 0),
+        "connections_opened": stats.get("connections_num", 0),
+        "connections_lost": stats.get("connections_lost", 0),
+        "health_check_failures": _health_check_failures,
+        "open_connections": stats["pool_size"],
+        "in_use": stats["pool_size"] - stats["pool_available"],
+        "idle": stats["pool_available"],
+        "waiting": stats["requests_waiting"],
+        "min_size": stats["pool_min"],
+        "max_size": stats["pool_max"],
+    }
+
+_scopes = weakref.WeakKeyDictionary() # connection -> app.user_id it is set to
+
+async def _set_scope(conn, scope:str):
+    # Outside a transaction so a rollback of the caller's work can not undo it, the setting stays with the
+    # connection and is only sent again when the next borrower acts for someone else
+    await conn.set_autocommit(True)
+    try:
+        await conn.execute("SELECT set_config('app.user_id', %s, false)", (scope,))
+        _scopes[conn] = scope
+    finally:
+        await conn.set_autocommit(False)
 
+@asynccontextmanager
+async def get_conn(user_id:str | None = None, system:bool = False):
+    """
+    Borrow a pooled connection, commit on success, rollback on error and hand it back to the pool.
+    The row level security policies let the connection see the rows of user_id only. Without a user it sees no
+    user's rows, work across users (migrations, the scheduler, rates and the cli) asks for system=True to see all.
+    """
+    if system and user_id is not None:
+        raise ValueError("A connection acts either for one user or for the system")
+    pool = await get_pool()
+    started = time.perf_counter()
+    # An empty app.user_id matches no row, forgetting the user fails closed
+    scope = "all" if system else (user_id or "")
+    async with pool.connection() as conn:
+        if _scopes.get(conn) != scope:
+            await _set_scope(conn, scope)
+        observe_stage("get_conn", started)
+        yield conn
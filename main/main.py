@@ -1,29 +1,146 @@
 from decimal import Decimal,ROUND_HALF_UP,InvalidOperation
-import sys,os
+import sys,os,json,asyncio,base64,re
 from fastmcp import FastMCP
-from datetime import date,datetime
+from fastmcp.server.dependencies import get_access_token
+from datetime import date,datetime,timedelta
 from typing import  Optional,Literal,TypedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from pydantic import BaseModel,Field
-import requests
-from init_db import get_conn,init_schema
-
-init_schema()
+from psycopg.rows import dict_row
+from init_db import get_conn,pool_stats,close_pool
+from fx import rate_cache,get_rate_on,get_rates_on,FX_HISTORY_MAX_AGE
+from cache import result_cache
+from migrations import migrate,ensure_partitions,seed_user_categories,CATEGORIES_PATH,FISCAL_YEAR_START_MONTH
+from recurring import due_occurrences,next_occurrence,parse_cron
+from periods import resolve_period
+from metrics import metrics,instrument,stage
 
 # Add startup logging
 # print("=== Expense Tracker MCP Server Starting ===", file=sys.stderr)
 # print(f"Python path: {sys.executable}", file=sys.stderr)
 # print(f"Working directory: {os.getcwd()}", file=sys.stderr)
 
-mcp = FastMCP("Expense Tracker")
+# Set DB_AUTO_MIGRATE=false to skip the startup schema check and run `python main/cli.py migrate` on deploy instead
+AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "true").lower() not in ("0", "false", "no")
+
+@asynccontextmanager
+async def lifespan(server):
+    # Nothing touches the database at import time. On startup the schema version is checked, which is two catalog reads,
+    # a partition and a calendar check when the schema is current, and the pool and the HTTP client stay open until shutdown.
+    scheduler = None
+    try:
+        if AUTO_MIGRATE:
+            await migrate()
+        if RECURRING_INTERVAL > 0:
+            scheduler = asyncio.create_task(recurring_scheduler())
+        yield {}
+    finally:
+        if scheduler:
+            scheduler.cancel()
+            await asyncio.gather(scheduler, return_exceptions=True)
+        await rate_cache.aclose()
+        await close_pool()
+
+mcp = FastMCP("Expense Tracker", lifespan=lifespan)
 
 # Choose the base currency from 'INR','AED','CAD','EUR','MYR','SEK','USD','AUD','CHF','GBP','JPY','PHP','SGD','ZAR','BRL','CNY','HKD','MXN','SAR','THB'
-BASE_CURRENCY = "INR"
+# After changing it run `python main/cli.py recompute-base` so stored base amounts follow
+BASE_CURRENCY = os.getenv("BASE_CURRENCY", "INR").strip().upper()
 
-CATEGORIES_PATH = os.path.join(os.path.dirname(__file__), "categories.json")
+# Set MULTI_USER=true to share one server between many users. Each request then acts for the user of its access
+# token, configure the token check with FastMCP's FASTMCP_SERVER_AUTH settings, and users are created with the default
+# categories on their first request. Otherwise every request acts for the local user and no token is needed.
+MULTI_USER = os.getenv("MULTI_USER", "false").lower() in ("1", "true", "yes")
 
 def  get_default_user_id()-> str:
     return '00000000-0000-0000-0000-000000000001'
 
+# Work outside a request, like the cli, acts for the user set here instead of the token's
+acting_user = ContextVar("acting_user", default=None)
+_user_ids = {} # token subject -> user id, a user's id never changes so entries are never stale
+
+async def resolve_user(external_id:str)-> str:
+    """Id of the user with this external id, the user is created on first sight."""
+    user_id = _user_ids.get(external_id)
+    if user_id is not None:
+        return user_id
+    async with get_conn(system=True) as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                "INSERT INTO users (id, external_id) VALUES (gen_random_uuid(), %s) ON CONFLICT (external_id) DO NOTHING RETURNING id",
+                (external_id,)
+            )
+            row = await cur.fetchone()
+            if row:
+                await seed_user_categories(conn, str(row[0]))
+            else:
+                await cur.execute("SELECT id FROM users WHERE external_id = %s", (external_id,))
+                row = await cur.fetchone()
+    user_id = _user_ids[external_id] = str(row[0])
+    return user_id
+
+async def current_user_id()-> str:
+    """The user the running request acts for."""
+    if acting_user.get() is not None:
+        return acting_user.get()
+    if not MULTI_USER:
+        return get_default_user_id()
+    token = get_access_token()
+    subject = token and (token.claims.get("sub") or token.client_id)
+    if not subject:
+        raise RuntimeError("Authentication required, MULTI_USER is set and the request has no access token")
+    return await resolve_user(subject)
+
+def invalidate_reads(user_id:str, expense_id:Optional[int] = None, all_expenses:bool = False, categories:bool = True, names:bool = False):
+    """Drop the cached reads of the user that a write to their expenses can change."""
+    if all_expenses:
+        result_cache.invalidate(user_id, "expense")
+    elif expense_id is not None:
+        result_cache.invalidate(user_id, "expense", expense_id)
+    if categories:
+        result_cache.invalidate(user_id, "categories")
+    if names:
+        result_cache.invalidate(user_id, "category_names")
+    result_cache.invalidate(user_id, "summary")
+
+def normalise_name(name:str)-> str:
+    """Category and subcategory names are stored lowercase with underscores, 'Dining Out' and 'dining-out' become 'dining_out'."""
+    return re.sub(r"[\s\-]+", "_", name.strip().lower())
+
+async def category_names(user_id:str)-> dict:
+    """The user's category list as {category: set of subcategories}, served from the result cache."""
+    async def fetch():
+        async with get_conn(user_id) as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT category, subcategory FROM user_categories WHERE user_id = %s", (user_id,))
+                names = {}
+                for category, subcategory in await cur.fetchall():
+                    names.setdefault(category, set())
+                    if subcategory:
+                        names[category].add(subcategory)
+                return names
+    return await result_cache.get_or_load(user_id, "category_names", None, fetch)
+
+def check_category(names:dict, category:str, subcategory:Optional[str] = None):
+    """Raise ValueError unless category, and subcategory when given, are in the user's category list."""
+    if category not in names:
+        raise ValueError(f"Unknown category '{category}'. Use one of {', '.join(sorted(names))} or add it with add_category")
+    if subcategory and subcategory not in names[category]:
+        raise ValueError(
+            f"Unknown subcategory '{subcategory}' of '{category}'. Use one of {', '.join(sorted(names[category])) or 'no subcategories'} or add it with add_category"
+        )
+
+# True when the category and subcategory an expense ends up with, the new one (the first and second parameter) or the
+# stored one, are in the user's category list. Updates that keep the stored category or subcategory check the pair here.
+CATEGORY_PAIR_EXISTS = """
+    EXISTS (
+        SELECT 1 FROM user_categories c
+        WHERE c.user_id = expenses.user_id AND c.category = COALESCE(%s, expenses.category)
+          AND c.subcategory = COALESCE(%s, expenses.subcategory, c.subcategory)
+    )
+"""
+
 # All the aggreagtion operations will be done on in base_amount. You can perform aggregation on original_amount only when grouped in a particular currency.
 class AddExpenseSchema(BaseModel):
     expense_date:str = Field(description = "Date of expense in format YYYY-MM-DD")
@@ -33,13 +150,9 @@ class AddExpenseSchema(BaseModel):
     description:Optional[str] = Field(description = "Description of the expense",default=None)
     currency:Literal['INR','AED','CAD','EUR','MYR','SEK','USD','AUD','CHF','GBP','JPY','PHP','SGD','ZAR','BRL','CNY','HKD','MXN','SAR','THB'] = Field(description = "Currency of the original_amount given by the user")
 
-@mcp.tool()
-def add_expense(expense : AddExpenseSchema):
-    """Add an expense to the database"""
-
-    user_id = get_default_user_id()
-    columns = [ "user_id","original_amount", "currency"]
-    params = [ user_id,expense.original_amount,expense.currency]
+def prepare_expense(expense:AddExpenseSchema)-> dict:
+    """Validate and normalise an expense, returns its column values without user_id and base_amount."""
+    record = {"original_amount": expense.original_amount, "currency": expense.currency}
 
     if not expense.expense_date.strip():
         raise ValueError("Date cannot be empty.")
@@ -51,74 +164,256 @@ def add_expense(expense : AddExpenseSchema):
             raise ValueError("Invalid date format. Use YYYY-MM-DD") from e # New exception from e
         if parsed_date > date.today():
             raise ValueError("Future dates are not allowed")
-        columns.append("expense_date")
-        params.append(expense.expense_date)
+        record["expense_date"] = parsed_date
 
         if expense.subcategory:
             if not expense.subcategory.strip():
                 raise ValueError("Subcategory cannot be an empty string.")                
-            columns.append("subcategory")
-            params.append(expense.subcategory.strip().lower())            
+            record["subcategory"] = normalise_name(expense.subcategory)
 
     if expense.description:
         if not expense.description.strip():
             raise ValueError("Description cannot be an empty string.") 
         else:
-            columns.append("description")
-            params.append(expense.description.strip().lower())   
+            record["description"] = expense.description.strip().lower()
+
+    if not expense.category.strip():
+        raise ValueError("Category cannot be empty" )
+    record["category"] = normalise_name(expense.category) # Checked against the user's category list by the caller
+    return record
+
+@mcp.tool()
+@instrument
+async def add_expense(expense : AddExpenseSchema):
+    """Add an expense to the database"""
+
+    user_id = await current_user_id()
+    with stage("validation"):
+        record = prepare_expense(expense)
+    check_category(await category_names(user_id), record["category"], record.get("subcategory"))
 
     # Perform Data Validation
     if expense.currency != BASE_CURRENCY:
         try:
-            response = convert_currency(expense.original_amount,expense.currency,BASE_CURRENCY)
+            with stage("fx_convert"):
+                response = await convert_currency(expense.original_amount,expense.currency,BASE_CURRENCY,record["expense_date"])
         except Exception as e:
             raise RuntimeError(f"Currency conversion failed: {e}")
 
         base_amount = response["result"]
     else:
         base_amount = expense.original_amount
-    columns.append("base_amount")
-    params.append(base_amount)
-
-    if not expense.category.strip():
-        raise ValueError("Category cannot be empty" )
-    columns.append("category")
-    params.append(expense.category.strip().lower()) # In future easy to look up using category and subcategory if they are in lower case
+    record["base_amount"] = base_amount
 
+    columns = ["user_id", *record.keys()]
+    params = [user_id, *record.values()]
     placeholders = ", ".join(["%s"] * len(columns))
+    # The budgets matching the new row come back from the same statement. The outer SELECT still sees the spend
+    # counters from before this insert, so the crossed thresholds are found without another round trip.
     query = f"""
-        INSERT INTO expenses ({", ".join(columns)})
-        VALUES ({placeholders})
-        RETURNING id
+        WITH inserted AS (
+            INSERT INTO expenses ({", ".join(columns)})
+            VALUES ({placeholders})
+            RETURNING id, user_id, expense_date, category, subcategory, base_amount
+        )
+        SELECT i.id, b.id AS budget_id, b.category, NULLIF(b.subcategory, '') AS subcategory, b.period, b.amount, b.alert_threshold,
+               COALESCE(s.spent, 0) AS spent_before, COALESCE(s.spent, 0) + i.base_amount AS spent_after
+        FROM inserted i
+        LEFT JOIN budgets b ON b.user_id = i.user_id AND b.category = i.category AND b.subcategory IN ('', COALESCE(i.subcategory, ''))
+        LEFT JOIN budget_spend s ON s.budget_id = b.id AND s.period_start = budget_period_start(b.period, i.expense_date)
     """
 
     try:
-        with get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute(query, tuple(params))
-                expense_id = cur.fetchone()[0] # Fetchone fetches only a single row from the result, since here the result only has one row it looks like (42,) and when [0] gets you the first column so we get 42 
-                return {
-                    "status": "success",
-                    "result":{"id": expense_id}
-                }
+        async with get_conn(user_id) as conn:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(query, tuple(params))
+                rows = await cur.fetchall()
     except Exception as e:
         raise RuntimeError("Failed to create expense") from e
+    invalidate_reads(user_id)
+
+    result = {"id": rows[0]["id"]}
+    alerts = budget_alerts(rows)
+    if alerts:
+        result["budget_alerts"] = alerts
+    return {
+        "status": "success",
+        "result": result
+    }
+
+
+BULK_COLUMNS = {
+    "expense_date": "date", "original_amount": "numeric", "currency": "text", "base_amount": "numeric",
+    "category": "text", "subcategory": "text", "description": "text",
+} # column -> array type the rows are sent as
+
+async def insert_expenses_bulk(expenses:list, skip_invalid:bool = False, row_errors:list | None = None)-> dict:
+    """
+    Validate, convert and load many expenses in one transaction.
+
+    expenses holds AddExpenseSchema records, row_errors holds errors found before this call (e.g. while parsing a CSV)
+    as {"row": index, "error": message} so they are reported together. Nothing is inserted when there is any error
+    unless skip_invalid is set, in which case only the valid rows are loaded.
+    """
+    user_id = await current_user_id()
+    errors = list(row_errors or [])
+    failed_rows = {error["row"] for error in errors}
+    records = []
+    names = await category_names(user_id)
+    with stage("validation"):
+        for row, expense in enumerate(expenses):
+            if expense is None or row in failed_rows:
+                continue
+            try:
+                record = prepare_expense(expense)
+                check_category(names, record["category"], record.get("subcategory"))
+                records.append((row, record))
+            except ValueError as e:
+                errors.append({"row": row, "error": str(e)})
+
+    # Rejected before any rate is looked up, a batch that is not inserted costs no rates API call
+    errors.sort(key=lambda error: error["row"])
+    if errors and not skip_invalid:
+        return {"status": "error", "result": {"inserted": 0, "ids": [], "errors": errors}}
+    if not records:
+        return {"status": "success", "result": {"inserted": 0, "ids": [], "errors": errors}}
+
+    # One rate lookup per distinct date and currency instead of one per row
+    try:
+        with stage("fx_convert"):
+            rates = await get_rates_on({(record["expense_date"], record["currency"]) for _, record in records}, BASE_CURRENCY)
+    except Exception as e:
+        raise RuntimeError(f"Currency conversion failed: {e}")
+    for _, record in records:
+        rate = rates[(record["expense_date"], record["currency"])]
+        record["base_amount"] = (rate * record["original_amount"]).quantize(Decimal("0.00"), rounding=ROUND_HALF_UP)
 
+    try:
+        async with get_conn(user_id) as conn:
+            async with conn.cursor() as cur:
+                # Reserve the ids first so the rows are loaded with explicit ids and every id maps back to its input row
+                await cur.execute(
+                    "SELECT nextval(pg_get_serial_sequence('expenses', 'id')) FROM generate_series(1, %s)",
+                    (len(records),)
+                )
+                ids = [row[0] for row in await cur.fetchall()]
+                # One INSERT of a column array each, COPY FROM is refused on a table with row level security
+                await cur.execute(
+                    f"""
+                    INSERT INTO expenses (id, user_id, {', '.join(BULK_COLUMNS)})
+                    SELECT v.id, %s::uuid, {', '.join(f"v.{column}" for column in BULK_COLUMNS)}
+                    FROM unnest(%s::bigint[], {', '.join(f"%s::{array_type}[]" for array_type in BULK_COLUMNS.values())})
+                        AS v(id, {', '.join(BULK_COLUMNS)})
+                    """,
+                    (user_id, ids, *([record.get(column) for _, record in records] for column in BULK_COLUMNS))
+                )
+    except Exception as e:
+        raise RuntimeError("Failed to create expenses") from e
+    invalidate_reads(user_id)
+
+    return {
+        "status": "success",
+        "result": {
+            "inserted": len(ids),
+            "ids": [{"row": row, "id": expense_id} for expense_id, (row, _) in zip(ids, records)],
+            "errors": errors
+        }
+    }
 
 @mcp.tool()
-def list_categories(subcategories:bool = False)-> dict:
+@instrument
+async def add_expenses_bulk(expenses:list[AddExpenseSchema], skip_invalid:bool = False):
     """
-    List all the categories and subcategories inside the database
+    Add many expenses in a single transaction.
+    All rows are validated first and errors are reported per row (0 based). By default nothing is inserted when any row is invalid,
+    set skip_invalid to load the valid rows anyway.
     """
-    user_id = get_default_user_id()
+    return await insert_expenses_bulk(expenses, skip_invalid)
+
+
+RECOMPUTE_CHUNK_SIZE = 5000
+
+async def recompute_base_amounts(chunk_size:int = RECOMPUTE_CHUNK_SIZE)-> dict:
+    """
+    Recompute base_amount of every expense in BASE_CURRENCY from fx_rates at the rate of its expense_date.
+
+    Runs one set based UPDATE per chunk of ids, each in its own transaction so locks stay short and an interrupted run
+    can simply be started again. Rows without a rate in fx_rates keep their base_amount and are counted as missing_rate.
+    """
+    if chunk_size < 1:
+        raise ValueError("Chunk size must be at least 1")
+    query = """
+        WITH chunk AS (
+            SELECT id, expense_date, currency, original_amount FROM expenses
+            WHERE id > %(after)s ORDER BY id LIMIT %(size)s
+        ),
+        converted AS (
+            SELECT c.id, CASE WHEN c.currency = %(base)s THEN c.original_amount
+                              ELSE round(c.original_amount * (t.rate / s.rate), 2) END AS base_amount
+            FROM chunk c
+            LEFT JOIN LATERAL (
+                SELECT rate FROM fx_rates
+                WHERE currency = c.currency AND rate_date <= c.expense_date AND rate_date > c.expense_date - %(max_age)s
+                ORDER BY rate_date DESC LIMIT 1
+            ) s ON true
+            LEFT JOIN LATERAL (
+                SELECT rate FROM fx_rates
+                WHERE currency = %(base)s AND rate_date <= c.expense_date AND rate_date > c.expense_date - %(max_age)s
+                ORDER BY rate_date DESC LIMIT 1
+            ) t ON true
+        ),
+        updated AS (
+            UPDATE expenses e
+            SET base_amount = v.base_amount, version = e.version + 1
+            FROM converted v
+            WHERE e.id = v.id AND v.base_amount IS NOT NULL AND e.base_amount <> v.base_amount
+            RETURNING 1
+        )
+        SELECT (SELECT MAX(id) FROM chunk), (SELECT COUNT(*) FROM chunk),
+               (SELECT COUNT(*) FROM converted WHERE base_amount IS NULL), (SELECT COUNT(*) FROM updated)
+    """
+    result = {"base_currency": BASE_CURRENCY, "scanned": 0, "updated": 0, "missing_rate": 0}
+    last_id = 0
     try:
-        with get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    "SELECT DISTINCT category, subcategory FROM expenses WHERE user_id = %s ORDER BY category, subcategory;",
+        while True:
+            async with get_conn(system=True) as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(query, {"after": last_id, "size": chunk_size, "base": BASE_CURRENCY, "max_age": FX_HISTORY_MAX_AGE})
+                    last_id, scanned, missing_rate, updated = await cur.fetchone()
+            if not scanned:
+                break
+            result["scanned"] += scanned
+            result["updated"] += updated
+            result["missing_rate"] += missing_rate
+    except Exception as e:
+        raise RuntimeError("Failed to recompute base amounts") from e
+    return {"status": "success", "result": result}
+
+
+@mcp.tool()
+@instrument
+async def list_categories(subcategories:bool = False, usage:bool = False)-> dict:
+    """
+    List the user's categories, optionally with their subcategories.
+    Set usage to get every category and subcategory with how many expenses use it and when it was last used, most used first.
+    """
+    user_id = await current_user_id()
+
+    async def fetch():
+        async with get_conn(user_id) as conn:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                # Reads the maintained category list, its primary key starts with user_id
+                await cur.execute(
+                    """
+                    SELECT category, NULLIF(subcategory, '') AS subcategory, usage_count, last_used
+                    FROM user_categories WHERE user_id = %s
+                    ORDER BY category, subcategory
+                    """,
                     (user_id,)
                 )
-                data = cur.fetchall()
+                return await cur.fetchall()
+    try:
+        data = await result_cache.get_or_load(user_id, "categories", None, fetch)
     except Exception as e:
         raise RuntimeError("Failed to fetch categories") from e
     if not data:
@@ -126,24 +421,55 @@ def list_categories(subcategories:bool = False)-> dict:
         "status": "success",
         "result":"No categories."            
         }
-    if subcategories:
+    if usage:
+        categories = sorted(data, key=lambda row: (-row["usage_count"], row["category"], row["subcategory"] or ""))
+    elif subcategories:
         categories = {}
-        for entry in data:
-            category, subcat = entry
-            if category not in categories:
-                # First time seeing this category
-                categories[category] = [subcat] if subcat else []
-            else:
-                # Category already exists
-                if subcat and subcat not in categories[category]:
-                    categories[category].append(subcat)
+        for row in data:
+            subcats = categories.setdefault(row["category"], [])
+            if row["subcategory"]:
+                subcats.append(row["subcategory"])
     else:
-        categories = sorted(set(row[0] for row in data)) # flatten list: [('Food',), ('Travel',), ('Rent',)] to ['Food', 'Travel', 'Rent']
+        categories = list(dict.fromkeys(row["category"] for row in data)) # Rows come sorted by category
     return {
         "status": "success",
         "result":{"categories":categories}
     }
 
+@mcp.tool()
+@instrument
+async def add_category(category:str, subcategory:Optional[str] = None)-> dict:
+    """
+    Add a category, or a subcategory of a category, to the user's category list.
+    Expenses can only use categories and subcategories from this list.
+    """
+    if not category.strip() or (subcategory is not None and not subcategory.strip()):
+        raise ValueError("Category and subcategory cannot be empty")
+    user_id = await current_user_id()
+    category = normalise_name(category)
+    subcategory = normalise_name(subcategory) if subcategory else ""
+    try:
+        async with get_conn(user_id) as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    """
+                    INSERT INTO user_categories (user_id, category, subcategory)
+                    SELECT %s, %s, unnest(ARRAY['', %s]::text[])
+                    ON CONFLICT (user_id, category, subcategory) DO NOTHING
+                    RETURNING subcategory
+                    """,
+                    (user_id, category, subcategory)
+                )
+                created = {row[0] for row in await cur.fetchall()}
+    except Exception as e:
+        raise RuntimeError("Failed to add category") from e
+    if created:
+        invalidate_reads(user_id, categories=True, names=True)
+    return {
+        "status": "success",
+        "result": {"category": category, "subcategory": subcategory or None, "created": (subcategory or "") in created}
+    }
+
 
 class FiltersSchema(BaseModel):
     min_amount:Optional[float] = Field(description="Minimum Amount  filter",default=None, gt=0)
@@ -152,37 +478,78 @@ class FiltersSchema(BaseModel):
     subcategory:Optional[str] = Field(description="Subcategory filter",default=None)
     start_date:Optional[str] = Field(description="Start Date filter in format YYYY-MM-DD",default=None)
     end_date:Optional[str] = Field(description="End Date filter in format YYYY-MM-DD",default=None)
+    period:Optional[str] = Field(
+        description="Date range by name instead of start_date and end_date: today, yesterday, this_week, last_week, this_month, last_month, "
+                    "this_quarter, last_quarter, this_year, last_year, this_fy, last_fy, last_n_days:30, 2025, 2025-03, q2_2026, fy2025 or fy2025_q1. "
+                    "Fiscal years are named by the year they end in",
+        default=None
+    )
     currency:Optional[Literal['INR','AED','CAD','EUR','MYR','SEK','USD','AUD','CHF','GBP','JPY','PHP','SGD','ZAR','BRL','CNY','HKD','MXN','SAR','THB']] = Field(description="Currency filter",default=None)
 
-@mcp.tool()
-def list_expenses(filters: FiltersSchema):
+def parse_filter_date(value:str, field:str)-> date:
+    try:
+        return datetime.strptime(value.strip(), "%Y-%m-%d").date()
+    except ValueError as e:
+        raise ValueError(f"Invalid {field} '{value}'. Use YYYY-MM-DD or a period") from e
+
+_calendar_periods = {} # period -> (start_date, end_date), rows only change with FISCAL_YEAR_START_MONTH which needs a restart
+
+async def period_bounds(token:str)-> tuple[date, date]:
+    """First and last day of a period token, calendar periods are read from calendar_periods once per process."""
+    period = resolve_period(token, date.today(), FISCAL_YEAR_START_MONTH)
+    if isinstance(period, tuple):
+        return period
+    bounds = _calendar_periods.get(period)
+    if bounds is None:
+        async with get_conn() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT start_date, end_date FROM calendar_periods WHERE period = %s", (period,))
+                row = await cur.fetchone()
+        if row is None:
+            raise ValueError(f"Period '{token}' is outside the calendar, which covers 1970 to 2100")
+        bounds = _calendar_periods[period] = (row[0], row[1])
+    return bounds
+
+async def resolve_dates(filters:FiltersSchema)-> dict | None:
     """
-    Fetch candidate expense records for listing, update, or deletion.
+    Replace the period of the filters with its start_date and end_date and check each date on its own.
+    Returns the date range the filters cover to echo back, None when they have no date bound.
+    """
+    token = filters.period
+    if token:
+        if filters.start_date or filters.end_date:
+            raise ValueError("Give either period or start_date and end_date, not both")
+        start_date, end_date = await period_bounds(token)
+        filters.period = None
+    else:
+        start_date = parse_filter_date(filters.start_date, "start_date") if filters.start_date else None
+        end_date = parse_filter_date(filters.end_date, "end_date") if filters.end_date else None
+        if start_date is None and end_date is None:
+            return None
+    if start_date and end_date and start_date > end_date:
+        raise ValueError("End date cannot be smaller than Start date")
+    filters.start_date = start_date.isoformat() if start_date else None
+    filters.end_date = end_date.isoformat() if end_date else None
+    return {"period": token, "start_date": filters.start_date, "end_date": filters.end_date}
+
+def build_filter_conditions(filters:FiltersSchema, require_filter:bool = True)-> tuple[list,list]:
+    """
+    Validate the filters and turn them into SQL conditions and params, the caller adds the user_id condition.
+    A period has to be resolved with resolve_dates first.
     """
-    
     if (filters.max_amount and filters.min_amount) and (filters.min_amount > filters.max_amount):
             raise ValueError("Minimum amount cannot be larger than maximum amount")
-    
-    if filters.end_date and filters.start_date:
-        filters.start_date = filters.start_date.strip()
-        filters.end_date = filters.end_date.strip()
-        try:
-            parsed_end_date = datetime.strptime(filters.end_date , "%Y-%m-%d").date()
-            parsed_start_date = datetime.strptime(filters.start_date , "%Y-%m-%d").date()
-            if parsed_start_date > parsed_end_date:
-                raise ValueError("End date cannot be smaller than Start date")
-        except ValueError as e:
-            raise ValueError("Invalid date format. Use YYYY-MM-DD") from e
-    
-    user_id = get_default_user_id()
+    if filters.period:
+        raise RuntimeError("Resolve the period with resolve_dates before building the filter conditions")
+
+    # Each bound is checked on its own, typed date params keep the range an index range scan
+    start_date = parse_filter_date(filters.start_date, "start_date") if filters.start_date else None
+    end_date = parse_filter_date(filters.end_date, "end_date") if filters.end_date else None
+    if start_date and end_date and start_date > end_date:
+        raise ValueError("End date cannot be smaller than Start date")
 
-    base_query = """
-        SELECT id, expense_date, original_amount, base_amount, category, subcategory, description, currency
-        FROM expenses
-        WHERE user_id = %s
-    """
     conditions = []
-    params = [user_id]
+    params = []
 
     if filters.min_amount is not None:
         conditions.append("base_amount >= %s")
@@ -195,62 +562,678 @@ def list_expenses(filters: FiltersSchema):
     # Search category and subcategory in lower cases.
     if filters.category:
         conditions.append("category = %s")
-        params.append(filters.category.strip().lower())
+        params.append(normalise_name(filters.category))
 
     if filters.subcategory:
         conditions.append("subcategory = %s")
-        params.append(filters.subcategory.strip().lower())
+        params.append(normalise_name(filters.subcategory))
 
-    if filters.start_date:
+    if start_date:
         conditions.append("expense_date >= %s")
-        params.append(filters.start_date)
+        params.append(start_date)
 
-    if filters.end_date:
+    if end_date:
         conditions.append("expense_date <= %s")
-        params.append(filters.end_date)
+        params.append(end_date)
     
     if filters.currency:
         conditions.append("currency = %s")
         params.append(filters.currency)
     
-    if len (params) == 1:
+    if require_filter and len (params) == 0:
         raise RuntimeError("Need atleast 1 filter to list expenses")
+    return conditions, params
 
-    if conditions:
-        base_query += " AND " + " AND ".join(conditions)
 
-    base_query += " ORDER BY expense_date DESC, base_amount DESC"
+EXPENSE_COLUMNS = ["id", "expense_date", "original_amount", "base_amount", "category", "subcategory", "description", "currency", "version", "recurring_id"]
+# list_expenses pages on this key, it must match the ORDER BY
+KEYSET_COLUMNS = ["expense_date", "base_amount", "id"]
+LIST_PAGE_MAX = 1000
 
+def encode_cursor(record:dict)-> str:
+    key = [record["expense_date"].isoformat(), str(record["base_amount"]), record["id"]]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+def decode_cursor(cursor:str)-> tuple:
     try:
-        with get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute(base_query, tuple(params))
-                rows = cur.fetchall()
-                columns = [desc[0] for desc in cur.description]
+        expense_date, base_amount, expense_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return date.fromisoformat(expense_date), Decimal(base_amount), int(expense_id)
+    except Exception as e:
+        raise ValueError("Invalid cursor, pass the next_cursor of the previous page as it is") from e
+
+@mcp.tool()
+@instrument
+async def list_expenses(
+    filters: FiltersSchema,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    columns: Optional[list[Literal["id", "expense_date", "original_amount", "base_amount", "category", "subcategory", "description", "currency", "version", "recurring_id"]]] = None
+):
+    """
+    Fetch candidate expense records for listing, update, or deletion.
+    Results are newest first and paged, pass next_cursor back as cursor with the same filters to get the next page.
+    Use columns to return only the fields you need.
+    """
+    with stage("validation"):
+        if limit < 1 or limit > LIST_PAGE_MAX:
+            raise ValueError(f"Limit must be between 1 and {LIST_PAGE_MAX}")
+        date_range = await resolve_dates(filters)
+        conditions, filter_params = build_filter_conditions(filters)
+
+        user_id = await current_user_id()
+        params = [user_id, *filter_params]
+
+        if cursor:
+            # Keyset pagination, seek past the last row of the previous page instead of using OFFSET
+            conditions.append("(expense_date, base_amount, id) < (%s, %s, %s)")
+            params.extend(decode_cursor(cursor))
+
+    output_columns = [column for column in EXPENSE_COLUMNS if not columns or column in columns]
+    select_columns = output_columns + [column for column in KEYSET_COLUMNS if column not in output_columns]
+
+    query = f"""
+        SELECT {", ".join(select_columns)}
+        FROM expenses
+        WHERE user_id = %s AND {" AND ".join(conditions)}
+        ORDER BY expense_date DESC, base_amount DESC, id DESC
+        LIMIT %s
+    """
+    params.append(limit + 1) # One extra row tells if there is a next page
+
+    try:
+        async with get_conn(user_id) as conn:
+            # Named cursor keeps the result on the server, only the page and one extra row are fetched
+            async with conn.cursor(name="list_expenses", row_factory=dict_row) as cur:
+                await cur.execute(query, tuple(params))
+                rows = await cur.fetchmany(limit + 1)
     except Exception as e:
         raise RuntimeError("Failed to fetch expenses") from e
-    
-    if not rows:
-        return {
-            "status": "success",
-            "result": {
-                "count": 0,
-                "records": []
-            }
-        }
 
-    records = []
-    for row in rows:
-        records.append(dict(zip(columns,row)))
+    has_more = len(rows) > limit
+    last_record = rows[limit - 1] if has_more else None
+    with stage("rows"):
+        records = [{column: record[column] for column in output_columns} for record in rows[:limit]]
 
     return {
         "status": "success",
         "result":{
             "count": len(records),
+            "date_range": date_range,
+            "records": records,
+            "next_cursor": encode_cursor(last_record) if has_more else None
+        }
+    }
+
+SEARCH_LIMIT_MAX = 100
+SEARCH_MIN_PREFIX = 3 # Shorter words match whole words only, 'a:*' would match most of the user's expenses
+SEARCH_TEXT = "expense_search_text(description, category, subcategory)" # Must match the expression of idx_expenses_search_trgm
+_trigram_search = None # Whether pg_trgm and its index exist, looked up once
+
+async def trigram_search_available(conn)-> bool:
+    global _trigram_search
+    if _trigram_search is None:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT to_regclass('idx_expenses_search_trgm') IS NOT NULL")
+            _trigram_search = (await cur.fetchone())[0]
+    return _trigram_search
+
+@mcp.tool()
+@instrument
+async def search_expenses(query: str, filters: Optional[FiltersSchema] = None, limit: int = 20):
+    """
+    Search expenses by words in the description, category or subcategory, best matches first.
+    Words of 3 or more letters match as prefixes ('ube' finds 'uber') and small misspellings are tolerated.
+    Combine with filters, e.g. a date range, to narrow the search.
+    """
+    if limit < 1 or limit > SEARCH_LIMIT_MAX:
+        raise ValueError(f"Limit must be between 1 and {SEARCH_LIMIT_MAX}")
+    words = re.findall(r"[^\W_]+", query.lower())
+    if not words:
+        raise ValueError("Search query must contain at least one word")
+    # Any word may match as a prefix, expenses matching more of the words rank higher
+    ts_query = " | ".join(f"{word}:*" if len(word) >= SEARCH_MIN_PREFIX else word for word in words)
+    text = " ".join(words)
+
+    filters = filters or FiltersSchema()
+    date_range = await resolve_dates(filters)
+    conditions, filter_params = build_filter_conditions(filters, require_filter=False)
+    user_id = await current_user_id()
+
+    try:
+        async with get_conn(user_id) as conn:
+            if await trigram_search_available(conn):
+                # Both arms are served by a GIN index, the planner ORs the two bitmaps
+                match = f"(search_vector @@ q OR %s <%% {SEARCH_TEXT})"
+                score = f"ts_rank(search_vector, q) + word_similarity(%s, {SEARCH_TEXT})"
+                match_params, score_params = [text], [text]
+            else:
+                match, score, match_params, score_params = "search_vector @@ q", "ts_rank(search_vector, q)", [], []
+            sql = f"""
+                SELECT {", ".join(EXPENSE_COLUMNS)}, ({score})::real AS score
+                FROM expenses, to_tsquery('simple', %s) AS q
+                WHERE user_id = %s AND {match} {"".join(f" AND {condition}" for condition in conditions)}
+                ORDER BY score DESC, expense_date DESC, id DESC
+                LIMIT %s
+            """
+            params = [*score_params, ts_query, user_id, *match_params, *filter_params, limit]
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(sql, tuple(params))
+                records = await cur.fetchall()
+    except Exception as e:
+        raise RuntimeError("Failed to search expenses") from e
+
+    for record in records:
+        record["score"] = round(record["score"], 4)
+    return {
+        "status": "success",
+        "result": {
+            "count": len(records),
+            "date_range": date_range,
             "records": records
         }
     }
 
+SUMMARY_PERIODS = ["day", "week", "month", "quarter", "year", "all"]
+
+def rollup_covers(filters:FiltersSchema, period:str)-> bool:
+    """
+    The monthly rollup can answer a summary when buckets and date bounds fall on month boundaries and no amount filter
+    is set. The dates are checked by resolve_dates first.
+    """
+    if period in ("day", "week") or filters.min_amount is not None or filters.max_amount is not None:
+        return False
+    if filters.start_date and date.fromisoformat(filters.start_date).day != 1:
+        return False
+    if filters.end_date and (date.fromisoformat(filters.end_date) + timedelta(days=1)).day != 1:
+        return False
+    return True
+
+@mcp.tool()
+@instrument
+async def summarize_expenses(
+    filters: Optional[FiltersSchema] = None,
+    period: Literal["day", "week", "month", "quarter", "year", "all"] = "month",
+    group_by: Optional[list[Literal["category", "subcategory", "currency"]]] = None
+):
+    """
+    Summarize expenses on the server, totals are in the base currency.
+    Groups by period (day, week, month, quarter, year or all) and optionally by category, subcategory and currency.
+    original_total is only returned when grouped by currency since amounts in different currencies cannot be added.
+    """
+    filters = filters or FiltersSchema()
+    group_by = [column for column in ["category", "subcategory", "currency"] if column in (group_by or [])]
+    user_id = await current_user_id()
+    date_range = await resolve_dates(filters)
+    use_rollup = rollup_covers(filters, period)
+
+    if use_rollup:
+        # Month buckets are read from the rollup, coarser periods are rolled up again from them
+        source = "expense_monthly_rollup"
+        date_column, total, original_total, count = "month", "SUM(total_base)", "SUM(total_original)", "SUM(expense_count)"
+        conditions, params = [], []
+        if filters.category:
+            conditions.append("category = %s")
+            params.append(normalise_name(filters.category))
+        if filters.subcategory:
+            conditions.append("subcategory = %s")
+            params.append(normalise_name(filters.subcategory))
+        if filters.start_date:
+            conditions.append("month >= %s")
+            params.append(filters.start_date.strip())
+        if filters.end_date:
+            conditions.append("month <= %s")
+            params.append(filters.end_date.strip())
+        if filters.currency:
+            conditions.append("currency = %s")
+            params.append(filters.currency)
+        select_columns = [column if column != "subcategory" else "NULLIF(subcategory, '') AS subcategory" for column in group_by]
+    else:
+        source = "expenses"
+        date_column, total, original_total, count = "expense_date", "SUM(base_amount)", "SUM(original_amount)", "COUNT(*)"
+        conditions, params = build_filter_conditions(filters, require_filter=False)
+        select_columns = list(group_by)
+
+    keys = list(group_by)
+    if period != "all":
+        select_columns.insert(0, f"date_trunc('{period}', {date_column})::date AS period_start")
+        keys.insert(0, "period_start")
+    select_columns += [f"{total} AS total", f"{count} AS count"]
+    if "currency" in group_by:
+        select_columns.append(f"{original_total} AS original_total")
+
+    query = f"""
+        SELECT {", ".join(select_columns)}
+        FROM {source}
+        WHERE {" AND ".join(["user_id = %s", *conditions])}
+        {"GROUP BY " + ", ".join(keys) if keys else ""}
+        HAVING {count} > 0
+        {"ORDER BY " + ", ".join(keys) if keys else ""}
+    """
+
+    async def fetch():
+        async with get_conn(user_id) as conn:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(query, (user_id, *params))
+                return await cur.fetchall()
+    try:
+        # The statement and its parameters identify the summary, equal requests share one entry
+        rows = await result_cache.get_or_load(user_id, "summary", (query, tuple(params)), fetch)
+    except Exception as e:
+        raise RuntimeError("Failed to summarize expenses") from e
+
+    return {
+        "status": "success",
+        "result": {
+            "period": period,
+            "group_by": group_by,
+            "date_range": date_range,
+            "base_currency": BASE_CURRENCY,
+            "source": "rollup" if use_rollup else "expenses",
+            "grand_total": sum((row["total"] for row in rows), Decimal("0.00")),
+            "rows": rows
+        }
+    }
+
+def budget_alerts(rows:list)-> list:
+    """Thresholds of the budgets crossed by an expense, from rows holding spent_before and spent_after."""
+    alerts = []
+    for row in rows:
+        if row["budget_id"] is None:
+            continue
+        for level, ratio in (("warning", row["alert_threshold"]), ("exceeded", Decimal(1))):
+            limit = row["amount"] * ratio
+            if row["spent_before"] < limit <= row["spent_after"]:
+                alerts.append({
+                    "budget_id": row["budget_id"],
+                    "category": row["category"],
+                    "subcategory": row["subcategory"],
+                    "period": row["period"],
+                    "level": level,
+                    "budget": row["amount"],
+                    "spent": row["spent_after"]
+                })
+    return alerts
+
+class BudgetSchema(BaseModel):
+    category:str = Field(description = "Category the budget applies to")
+    subcategory:Optional[str] = Field(description = "Subcategory the budget applies to, leave empty to cover the whole category", default=None)
+    period:Literal['monthly','quarterly','half_yearly','yearly'] = Field(description = "Budget period")
+    amount:Decimal = Field(description = f"Budget amount in the base currency ({BASE_CURRENCY})", max_digits=12, decimal_places=2, gt=0)
+    alert_threshold:Decimal = Field(description = "Fraction of the budget at which a warning is raised", default=Decimal("0.8"), gt=0, le=1)
+
+@mcp.tool()
+@instrument
+async def set_budget(budget: BudgetSchema):
+    """Create a budget or change the amount and alert threshold of an existing one, amounts are in the base currency"""
+    user_id = await current_user_id()
+    if not budget.category.strip():
+        raise ValueError("Category cannot be empty")
+    if budget.subcategory is not None and not budget.subcategory.strip():
+        raise ValueError("Subcategory cannot be an empty string.")
+    category = normalise_name(budget.category)
+    subcategory = normalise_name(budget.subcategory) if budget.subcategory else ""
+    check_category(await category_names(user_id), category, subcategory)
+
+    try:
+        async with get_conn(user_id) as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    """
+                    INSERT INTO budgets (user_id, category, subcategory, period, amount, alert_threshold)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (user_id, category, subcategory, period) DO UPDATE
+                    SET amount = EXCLUDED.amount, alert_threshold = EXCLUDED.alert_threshold
+                    RETURNING id, (xmax = 0) AS created
+                    """,
+                    (user_id, category, subcategory, budget.period, budget.amount, budget.alert_threshold)
+                )
+                budget_id, created = await cur.fetchone()
+                if created:
+                    # Seed the counters of a new budget from the monthly rollup, the triggers keep them current afterwards
+                    await cur.execute(
+                        """
+                        INSERT INTO budget_spend (budget_id, period_start, spent)
+                        SELECT %s, budget_period_start(%s, month), SUM(total_base)
+                        FROM expense_monthly_rollup
+                        WHERE user_id = %s AND category = %s AND (%s = '' OR subcategory = %s)
+                        GROUP BY 2
+                        """,
+                        (budget_id, budget.period, user_id, category, subcategory, subcategory)
+                    )
+    except Exception as e:
+        raise RuntimeError("Failed to save budget") from e
+    return {"status": "success", "result": {"id": budget_id, "created": created}}
+
+@mcp.tool()
+@instrument
+async def get_budget_status(on_date: Optional[str] = None, category: Optional[str] = None):
+    """
+    Report spent and remaining amount of every budget for the period containing on_date (YYYY-MM-DD, default today).
+    """
+    user_id = await current_user_id()
+    if on_date:
+        try:
+            day = datetime.strptime(on_date.strip(), "%Y-%m-%d").date()
+        except ValueError as e:
+            raise ValueError("Invalid date format. Use YYYY-MM-DD") from e
+    else:
+        day = date.today()
+
+    query = """
+        SELECT b.id, b.category, NULLIF(b.subcategory, '') AS subcategory, b.period, b.amount, b.alert_threshold,
+               budget_period_start(b.period, %s) AS period_start, COALESCE(s.spent, 0) AS spent
+        FROM budgets b
+        LEFT JOIN budget_spend s ON s.budget_id = b.id AND s.period_start = budget_period_start(b.period, %s)
+        WHERE b.user_id = %s
+    """
+    params = [day, day, user_id]
+    if category:
+        query += " AND b.category = %s"
+        params.append(normalise_name(category))
+    query += " ORDER BY b.category, b.subcategory, b.period"
+
+    try:
+        async with get_conn(user_id) as conn:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(query, tuple(params))
+                rows = await cur.fetchall()
+    except Exception as e:
+        raise RuntimeError("Failed to fetch budgets") from e
+
+    budgets = []
+    for row in rows:
+        amount, spent = row["amount"], row["spent"]
+        if spent >= amount:
+            status = "exceeded"
+        elif spent >= amount * row["alert_threshold"]:
+            status = "warning"
+        else:
+            status = "ok"
+        budgets.append({
+            "id": row["id"],
+            "category": row["category"],
+            "subcategory": row["subcategory"],
+            "period": row["period"],
+            "period_start": row["period_start"],
+            "budget": amount,
+            "spent": spent,
+            "remaining": amount - spent,
+            "used_percent": (spent * 100 / amount).quantize(Decimal("0.1"), rounding=ROUND_HALF_UP),
+            "status": status
+        })
+    return {"status": "success", "result": {"base_currency": BASE_CURRENCY, "budgets": budgets}}
+
+@mcp.tool()
+@instrument
+async def delete_budget(budget_id:int):
+    """Delete a budget and its spend counters"""
+    user_id = await current_user_id()
+    try:
+        async with get_conn(user_id) as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("DELETE FROM budgets WHERE user_id = %s AND id = %s;", (user_id, budget_id))
+                rows_affected = cur.rowcount
+    except Exception as e:
+        raise RuntimeError("Deletion failed") from e
+    if rows_affected == 0:
+        raise RuntimeError("No such budget exists")
+    return {"status": "success", "result": {"rows_affected": rows_affected}}
+
+
+# Recurring expenses are materialised on startup, which catches up on occurrences missed while the server was down,
+# and then every RECURRING_INTERVAL seconds, together with the expense partition check. Set it to 0 to run `python main/cli.py materialise-recurring` from cron instead.
+RECURRING_INTERVAL = float(os.getenv("RECURRING_INTERVAL", "3600"))
+
+class RecurringExpenseSchema(BaseModel):
+    frequency:Literal['daily','weekly','monthly','yearly','cron'] = Field(description = "How often the expense repeats, use cron together with the cron field")
+    interval_count:int = Field(description = "Repeat every interval_count days, weeks, months or years", default=1, gt=0)
+    cron:Optional[str] = Field(description = "Cron day fields 'day-of-month month day-of-week' for frequency cron, e.g. '1,15 * *' or '* * mon-fri'", default=None)
+    start_date:str = Field(description = "First occurrence in format YYYY-MM-DD, occurrences in the past are added right away")
+    end_date:Optional[str] = Field(description = "Date of the last possible occurrence in format YYYY-MM-DD", default=None)
+    original_amount:Decimal = Field(description = "Expense amount in the currency given by user.",max_digits=10, decimal_places=2, gt=0)
+    category:str = Field(description = "Category of the expense")
+    subcategory:Optional[str] = Field(description = "Subcategory of the expense", default=None)
+    description:Optional[str] = Field(description = "Description of the expense",default=None)
+    currency:Literal['INR','AED','CAD','EUR','MYR','SEK','USD','AUD','CHF','GBP','JPY','PHP','SGD','ZAR','BRL','CNY','HKD','MXN','SAR','THB'] = Field(description = "Currency of the original_amount given by the user")
+
+async def materialise_recurring_expenses(recurring_ids:Optional[list] = None)-> dict:
+    """
+    Insert every occurrence of the recurring rules of all users that is due by today, in one transaction.
+
+    Occurrences are unique per (recurring_id, expense_date), so a rerun or a second server running at the same time
+    inserts nothing twice. Each currency costs one rate lookup per run however many occurrences use it. Rules whose
+    currency cannot be converted keep their next_date and are caught up on the next run.
+    """
+    today = date.today()
+    query = """
+        SELECT id, user_id, frequency, interval_count, cron, start_date, end_date, next_date, original_amount, currency
+        FROM recurring_expenses
+        WHERE next_date <= %s
+    """
+    params = [today]
+    if recurring_ids is not None:
+        query += " AND id = ANY(%s)"
+        params.append(recurring_ids)
+    try:
+        async with get_conn(system=True) as conn:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(query, tuple(params))
+                rules = await cur.fetchall()
+    except Exception as e:
+        raise RuntimeError("Failed to fetch recurring expenses") from e
+
+    due = [(rule, *due_occurrences(rule, today)) for rule in rules]
+    currencies = sorted({rule["currency"] for rule in rules})
+    lookups = await asyncio.gather(
+        *(get_rates_on({(day, currency) for rule, days, _ in due if rule["currency"] == currency for day in days}, BASE_CURRENCY) for currency in currencies),
+        return_exceptions=True
+    )
+    rates = {}
+    errors = []
+    for currency, lookup in zip(currencies, lookups):
+        if isinstance(lookup, Exception):
+            errors.append({"currency": currency, "error": f"Currency conversion failed: {lookup}"})
+        else:
+            rates.update(lookup)
+
+    occurrence_ids, occurrence_dates, base_amounts = [], [], []
+    rule_ids, next_dates = [], []
+    for rule, days, next_date in due:
+        if any((day, rule["currency"]) not in rates for day in days):
+            continue
+        for day in days:
+            occurrence_ids.append(rule["id"])
+            occurrence_dates.append(day)
+            base_amounts.append((rates[(day, rule["currency"])] * rule["original_amount"]).quantize(Decimal("0.00"), rounding=ROUND_HALF_UP))
+        rule_ids.append(rule["id"])
+        next_dates.append(next_date)
+
+    inserted = {}
+    if rule_ids:
+        try:
+            async with get_conn(system=True) as conn:
+                async with conn.cursor() as cur:
+                    # The rule columns come from the table, only the dates and converted amounts are sent
+                    await cur.execute(
+                        """
+                        WITH inserted AS (
+                            INSERT INTO expenses (user_id, recurring_id, expense_date, original_amount, currency, base_amount, category, subcategory, description)
+                            SELECT r.user_id, r.id, o.expense_date, r.original_amount, r.currency, o.base_amount, r.category, r.subcategory, r.description
+                            FROM unnest(%s::int[], %s::date[], %s::numeric[]) AS o(recurring_id, expense_date, base_amount)
+                            JOIN recurring_expenses r ON r.id = o.recurring_id
+                            ON CONFLICT (recurring_id, expense_date) DO NOTHING
+                            RETURNING user_id
+                        )
+                        SELECT user_id::text, COUNT(*) FROM inserted GROUP BY 1
+                        """,
+                        (occurrence_ids, occurrence_dates, base_amounts)
+                    )
+                    inserted = dict(await cur.fetchall())
+                    # next_date only moves forward, a slower concurrent run cannot move it back
+                    await cur.execute(
+                        """
+                        UPDATE recurring_expenses r SET next_date = n.next_date
+                        FROM unnest(%s::int[], %s::date[]) AS n(id, next_date)
+                        WHERE r.id = n.id AND r.next_date IS NOT NULL AND (n.next_date IS NULL OR r.next_date < n.next_date)
+                        """,
+                        (rule_ids, next_dates)
+                    )
+        except Exception as e:
+            raise RuntimeError("Failed to materialise recurring expenses") from e
+    for user_id in inserted:
+        invalidate_reads(user_id)
+
+    return {
+        "status": "success",
+        "result": {
+            "due_rules": len(rules),
+            "occurrences": len(occurrence_ids),
+            "inserted": sum(inserted.values()),
+            "errors": errors
+        }
+    }
+
+async def recurring_scheduler():
+    while True:
+        # The coming partitions are created on the way, a long running server would otherwise only get them on restart
+        # and write the new interval, and backdated rows, into the default partition
+        try:
+            async with get_conn(system=True) as conn:
+                await ensure_partitions(conn)
+        except Exception as e:
+            print(f"Partition maintenance failed: {e}", file=sys.stderr)
+        try:
+            await materialise_recurring_expenses()
+        except Exception as e:
+            print(f"Recurring expenses run failed: {e}", file=sys.stderr)
+        await asyncio.sleep(RECURRING_INTERVAL)
+
+def parse_rule_date(value:str)-> date:
+    try:
+        return datetime.strptime(value.strip(), "%Y-%m-%d").date()
+    except ValueError as e:
+        raise ValueError("Invalid date format. Use YYYY-MM-DD") from e
+
+@mcp.tool()
+@instrument
+async def add_recurring_expense(rule: RecurringExpenseSchema):
+    """
+    Add an expense that repeats, e.g. rent on the 1st of every month or a subscription every year.
+    Occurrences from start_date up to today are added right away, later ones as they fall due.
+    """
+    user_id = await current_user_id()
+    record = {
+        "frequency": rule.frequency,
+        "interval_count": rule.interval_count,
+        "cron": None,
+        "start_date": parse_rule_date(rule.start_date),
+        "end_date": parse_rule_date(rule.end_date) if rule.end_date else None,
+    }
+    if rule.frequency == "cron":
+        if not rule.cron or not rule.cron.strip():
+            raise ValueError("Frequency cron needs a cron expression")
+        record["cron"] = " ".join(rule.cron.split())
+        parse_cron(record["cron"])
+    elif rule.cron:
+        raise ValueError("A cron expression needs frequency cron")
+    if record["end_date"] and record["end_date"] < record["start_date"]:
+        raise ValueError("End date cannot be smaller than Start date")
+    record["next_date"] = next_occurrence(record, record["start_date"])
+    if record["next_date"] is None:
+        raise ValueError("The rule has no occurrence between its start and end date")
+
+    if not rule.category.strip():
+        raise ValueError("Category cannot be empty")
+    if rule.subcategory is not None and not rule.subcategory.strip():
+        raise ValueError("Subcategory cannot be an empty string.")
+    if rule.description is not None and not rule.description.strip():
+        raise ValueError("Description cannot be an empty string.")
+    record["category"] = normalise_name(rule.category)
+    record["subcategory"] = normalise_name(rule.subcategory) if rule.subcategory else None
+    record["description"] = rule.description.strip().lower() if rule.description else None
+    check_category(await category_names(user_id), record["category"], record["subcategory"])
+    record["original_amount"] = rule.original_amount
+    record["currency"] = rule.currency
+
+    columns = ["user_id", *record.keys()]
+    try:
+        async with get_conn(user_id) as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    f"INSERT INTO recurring_expenses ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))}) RETURNING id",
+                    (user_id, *record.values())
+                )
+                recurring_id = (await cur.fetchone())[0]
+    except Exception as e:
+        raise RuntimeError("Failed to create recurring expense") from e
+
+    materialised = await materialise_recurring_expenses([recurring_id])
+    try:
+        async with get_conn(user_id) as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT next_date FROM recurring_expenses WHERE id = %s", (recurring_id,))
+                next_date = (await cur.fetchone())[0]
+    except Exception as e:
+        raise RuntimeError("Failed to fetch recurring expense") from e
+    return {
+        "status": "success",
+        "result": {
+            "id": recurring_id,
+            "inserted": materialised["result"]["inserted"],
+            "next_date": next_date,
+            "errors": materialised["result"]["errors"]
+        }
+    }
+
+@mcp.tool()
+@instrument
+async def list_recurring_expenses():
+    """List the recurring expense rules with their next due date, next_date is null once a rule has ended"""
+    user_id = await current_user_id()
+    try:
+        async with get_conn(user_id) as conn:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(
+                    """
+                    SELECT id, frequency, interval_count, cron, start_date, end_date, next_date,
+                           original_amount, currency, category, subcategory, description
+                    FROM recurring_expenses
+                    WHERE user_id = %s
+                    ORDER BY id
+                    """,
+                    (user_id,)
+                )
+                rules = await cur.fetchall()
+    except Exception as e:
+        raise RuntimeError("Failed to fetch recurring expenses") from e
+    return {"status": "success", "result": {"count": len(rules), "rules": rules}}
+
+@mcp.tool()
+@instrument
+async def delete_recurring_expense(recurring_id:int, delete_expenses:bool = False):
+    """
+    Delete a recurring expense rule so no further occurrences are added.
+    The expenses it already added are kept unless delete_expenses is set.
+    """
+    user_id = await current_user_id()
+    try:
+        async with get_conn(user_id) as conn:
+            async with conn.cursor() as cur:
+                expenses_deleted = 0
+                if delete_expenses:
+                    await cur.execute("DELETE FROM expenses WHERE user_id = %s AND recurring_id = %s", (user_id, recurring_id))
+                    expenses_deleted = cur.rowcount
+                # Expenses that are kept lose their recurring_id through the foreign key
+                await cur.execute("DELETE FROM recurring_expenses WHERE user_id = %s AND id = %s", (user_id, recurring_id))
+                rows_affected = cur.rowcount
+    except Exception as e:
+        raise RuntimeError("Deletion failed") from e
+    if rows_affected == 0:
+        raise RuntimeError("No such recurring expense exists")
+    invalidate_reads(user_id, all_expenses=True)
+    return {"status": "success", "result": {"rows_affected": rows_affected, "expenses_deleted": expenses_deleted}}
+
+
 # Inherit Insert Schema
 class ExpenseUpdateSchema(AddExpenseSchema):
     expense_date: Optional[str] = Field(description = "Date of expense in format YYYY-MM-DD",default=None)
@@ -262,8 +1245,12 @@ class ExpenseUpdateSchema(AddExpenseSchema):
     ] = Field(description = "Currency of the original_amount given by the user",default=None)
 
 @mcp.tool()
-def update_expense(expense_id: int, data: ExpenseUpdateSchema):
-    """ Update an expense """
+@instrument
+async def update_expense(expense_id: int, data: ExpenseUpdateSchema, expected_version: Optional[int] = None):
+    """
+    Update an expense.
+    Pass the version returned by get_expense or list_expenses as expected_version to fail instead of overwriting a newer change.
+    """
     update_dict = {}
     allowed_fields = ['expense_date','original_amount','category','subcategory','description','currency']
     raw_data = data.model_dump(exclude_unset=True) # Do not include None field, if LLM sent null it will be included
@@ -273,43 +1260,29 @@ def update_expense(expense_id: int, data: ExpenseUpdateSchema):
     for field, value in raw_data.items():
         if value is not None:
             updates[field] = value
-    update_fields = list(set(allowed_fields) & set(updates.keys()))
-    user_id = get_default_user_id()
+    update_fields = [field for field in allowed_fields if field in updates]
+    user_id = await current_user_id()
     if len(update_fields) == 0:
         raise RuntimeError("Either the updates dict is empty or given columns cannot be updated.")
-    try:
-        with get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute(f"SELECT {', '.join(update_fields)} FROM expenses WHERE id = %s AND user_id = %s",(expense_id,user_id))
-                row = cur.fetchone()
-                if not row:
-                    raise RuntimeError("No such record exists")
-    except Exception as e:
-        raise RuntimeError("Failed to fetch record") from e
-    db_record = dict(zip(update_fields, row))
+
+    # Validate everything up front, comparing with the stored values is left to the UPDATE itself
     for column in update_fields:
             value = updates[column]
-            db_value = db_record[column]
             if column == 'expense_date':
                 if value.strip():
                     value = value.strip()
-                    if value == db_value:
-                        raise RuntimeError("Both stored and new date are same")
                     try:
                         parsed_date = datetime.strptime(value, "%Y-%m-%d").date()
                     except ValueError as e:
                         raise ValueError("Invalid date format. Use YYYY-MM-DD in string format") from e
                     if parsed_date > date.today():
                         raise ValueError("Future dates are not allowed")
-                    update_dict[column] = value
+                    update_dict[column] = parsed_date
                 else:
                     raise TypeError("Date can only be non empty string in YYYY-MM-DD format.")
             elif column in ['category','subcategory','description']:
                 if value.strip():
-                    value = value.strip().lower()
-                    if value == db_value:
-                        raise RuntimeError(f"Both stored and new {column} are same")
-                    update_dict[column] = value
+                    update_dict[column] = normalise_name(value) if column != 'description' else value.strip().lower()
                 else:
                     raise TypeError(f"{column} can only be a string")               
             elif column  == 'original_amount' or column == 'currency':
@@ -319,101 +1292,294 @@ def update_expense(expense_id: int, data: ExpenseUpdateSchema):
                     raise RuntimeError("You cannot update currency without provding the original amount in updates" )
                  
                 try:
-                    new_amount= Decimal(updates["original_amount"])
+                    update_dict['original_amount'] = Decimal(updates["original_amount"])
                 except InvalidOperation as e:
                     raise InvalidOperation ("Amount can only be Decimal") from e
-                new_currency = updates['currency']
-                db_amount = db_record['original_amount']
-                db_currency = db_record['currency']
-                amount_changed = new_amount != db_amount
-                currency_changed = new_currency != db_currency
-                if not amount_changed and not currency_changed:
-                    raise RuntimeError("Both currency and amount are same as the values in the database")
-                if amount_changed:
-                    update_dict['original_amount'] = new_amount
-
-                if currency_changed:
-                    update_dict['currency'] = new_currency
-
-                if amount_changed or currency_changed:
-                    effective_currency = new_currency
-                    effective_amount = new_amount
-
-                    if effective_currency != BASE_CURRENCY:
-                        try:
-                            response = convert_currency(effective_amount, effective_currency, BASE_CURRENCY)
-                        except Exception as e:
-                            raise RuntimeError(f"Currency conversion failed: {e}")
-                        update_dict["base_amount"] = response["result"]
-                    else:
-                        update_dict["base_amount"] = effective_amount
-    set_clauses = []
-    params = []
+                update_dict['currency'] = updates['currency']
 
-    if not update_dict:
-        raise RuntimeError("No changes detected")
+    if 'category' in update_dict:
+        check_category(await category_names(user_id), update_dict['category'], update_dict.get('subcategory'))
 
+    set_clauses = []
+    set_params = []
     for column, value in update_dict.items():
         set_clauses.append(f"{column} = %s")
-        params.append(value)
+        set_params.append(value)
+
+    # A new amount, currency or date changes the base amount. It is converted in the statement at the rate of the
+    # resulting date and currency, which may come from the stored row, so changing only the date of a foreign currency
+    # expense converts it again as well.
+    reconvert = 'currency' in update_dict or 'expense_date' in update_dict
+    if reconvert:
+        set_clauses.append("base_amount = round(COALESCE(%s, original_amount) * rate.rate, 2)")
+        set_params.append(update_dict.get('original_amount'))
+
+    # Change detection runs in SQL, the row is only written when at least one given value differs from the stored one
+    change_clauses = []
+    change_params = []
+    for column in ['expense_date','category','subcategory','description']:
+        if column in update_dict:
+            change_clauses.append(f"{column} IS DISTINCT FROM %s")
+            change_params.append(update_dict[column])
+    if 'currency' in update_dict:
+        change_clauses.append("(original_amount, currency) IS DISTINCT FROM (%s, %s)")
+        change_params.extend([update_dict['original_amount'], update_dict['currency']])
+
+    version_clause = ""
+    version_params = []
+    if expected_version is not None:
+        version_clause = "AND version = %s"
+        version_params.append(expected_version)
 
+    # One statement: the CTEs read the stored version for reporting, check the resulting category and subcategory and
+    # read the rate of the resulting date and currency from fx_rates, the UPDATE is the compare and set. Under concurrent writers the UPDATE re-checks its WHERE clause
+    # on the latest row version. Without a rate in the history the row is left alone and the live rate is passed in
+    # for a second run, like get_rates_on falls back to it.
+    recategorised = 'category' in update_dict or 'subcategory' in update_dict
     query = f"""
-        UPDATE expenses
-        SET {', '.join(set_clauses)}
-        WHERE id = %s AND user_id = %s
+        WITH stored AS (
+            SELECT version, COALESCE(%s, currency) AS currency, COALESCE(%s::date, expense_date) AS expense_date,
+                   COALESCE(%s, category) AS category, COALESCE(%s, subcategory) AS subcategory,
+                   {CATEGORY_PAIR_EXISTS if recategorised else "true"} AS category_ok
+            FROM expenses WHERE id = %s AND user_id = %s
+        ), rate AS (
+            SELECT CASE WHEN s.currency = %s THEN 1 ELSE COALESCE(t.rate / f.rate, %s) END AS rate, s.category_ok
+            FROM stored s
+            LEFT JOIN LATERAL (
+                SELECT rate FROM fx_rates
+                WHERE currency = s.currency AND rate_date <= s.expense_date AND rate_date > s.expense_date - %s
+                ORDER BY rate_date DESC LIMIT 1
+            ) f ON true
+            LEFT JOIN LATERAL (
+                SELECT rate FROM fx_rates
+                WHERE currency = %s AND rate_date <= s.expense_date AND rate_date > s.expense_date - %s
+                ORDER BY rate_date DESC LIMIT 1
+            ) t ON true
+        ), updated AS (
+            UPDATE expenses
+            SET {', '.join(set_clauses)}, version = version + 1
+            FROM rate
+            WHERE id = %s AND user_id = %s {version_clause} AND ({' OR '.join(change_clauses)}) AND rate.category_ok
+              {"AND rate.rate IS NOT NULL" if reconvert else ""}
+            RETURNING version
+        )
+        SELECT stored.version AS stored_version, updated.version AS new_version, stored.currency, stored.expense_date,
+               rate.rate IS NULL AS missing_rate, stored.category_ok, stored.category, stored.subcategory
+        FROM stored CROSS JOIN rate LEFT JOIN updated ON TRUE
     """
-    params.extend([expense_id, user_id])
 
-    try:
-        with get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute(query, tuple(params))
-                rows_affected = cur.rowcount
-    except Exception as e:
-        raise RuntimeError("Update Failed") from e
-    
+    async def run_update(live_rate:Decimal | None):
+        params = [
+            update_dict.get('currency'), update_dict.get('expense_date'),
+            update_dict.get('category'), update_dict.get('subcategory'),
+            *([update_dict.get('category'), update_dict.get('subcategory')] if recategorised else []), expense_id, user_id,
+            BASE_CURRENCY, live_rate, FX_HISTORY_MAX_AGE, BASE_CURRENCY, FX_HISTORY_MAX_AGE,
+            *set_params, expense_id, user_id, *version_params, *change_params
+        ]
+        try:
+            async with get_conn(user_id) as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(query, tuple(params))
+                    return await cur.fetchone()
+        except Exception as e:
+            raise RuntimeError("Update Failed") from e
+
+    row = await run_update(None)
+    if row is not None and reconvert and row[4]:
+        try:
+            with stage("fx_convert"):
+                live_rate = await get_rate_on(row[2], BASE_CURRENCY, row[3])
+        except Exception as e:
+            raise RuntimeError(f"Currency conversion failed: {e}")
+        row = await run_update(live_rate)
+
+    if row is None:
+        raise RuntimeError("No such record exists")
+    stored_version, new_version = row[0], row[1]
+    if new_version is None and not row[5]:
+        # A subcategory that is not in the category, the new one or the one the expense keeps
+        check_category(await category_names(user_id), row[6], row[7])
+        raise ValueError(f"Unknown subcategory '{row[7]}' of '{row[6]}', add it with add_category")
+    if new_version is None:
+        if expected_version is not None and stored_version != expected_version:
+            raise RuntimeError(
+                f"Version conflict: expected version {expected_version} but the expense is at version {stored_version}. "
+                "It was changed after you read it, fetch it again and retry."
+            )
+        raise RuntimeError("No changes detected, the given values are the same as the stored ones")
+    invalidate_reads(user_id, expense_id, categories=recategorised, names=recategorised)
+
     return {
         "status": "success",
         "result":{
-            "rows_affected": rows_affected
+            "rows_affected": 1,
+            "version": new_version
         }
     }
 
 
 @mcp.tool()
-def delete_expense(expense_id:int):
+@instrument
+async def delete_expense(expense_id:int):
     """Delete an expense from database"""
-    user_id = get_default_user_id()
+    user_id = await current_user_id()
 
     query = "DELETE FROM expenses WHERE user_id = %s AND id = %s;"
     try:
-        with get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute(query, (user_id,expense_id))
+        async with get_conn(user_id) as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, (user_id,expense_id))
                 rows_affected = cur.rowcount
     except Exception as e:
         raise RuntimeError("Deletion failed") from e
     if rows_affected == 0:
         raise RuntimeError("No such expense record exists")
     else:
+        invalidate_reads(user_id, expense_id)
         return {"status":"success", "result":{"rows_affected": rows_affected}}
 
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "1000"))
+
+def check_max_rows(max_rows:int):
+    if max_rows < 1 or max_rows > BULK_MAX_ROWS:
+        raise ValueError(f"max_rows must be between 1 and {BULK_MAX_ROWS}")
+
+class BulkUpdateSchema(BaseModel):
+    category:Optional[str] = Field(description = "New category", default=None)
+    subcategory:Optional[str] = Field(description = "New subcategory", default=None)
+    description:Optional[str] = Field(description = "New description", default=None)
+
+@mcp.tool()
+@instrument
+async def bulk_update_expenses(filters: FiltersSchema, data: BulkUpdateSchema, dry_run: bool = False, max_rows: int = 100):
+    """
+    Update category, subcategory or description of every expense matching the list_expenses filters in one statement.
+    Use dry_run to get only the number of expenses that would change. Fails without changing anything when more than max_rows would change.
+    """
+    check_max_rows(max_rows)
+    updates = {}
+    for column, value in data.model_dump(exclude_none=True).items():
+        if not value.strip():
+            raise TypeError(f"{column} can only be a non empty string")
+        updates[column] = normalise_name(value) if column != "description" else value.strip().lower()
+    if not updates:
+        raise RuntimeError("Nothing to update, give at least one of category, subcategory or description")
+    user_id = await current_user_id()
+    if "category" in updates:
+        check_category(await category_names(user_id), updates["category"], updates.get("subcategory"))
+
+    recategorised = 'category' in updates or 'subcategory' in updates
+
+    date_range = await resolve_dates(filters)
+    conditions, filter_params = build_filter_conditions(filters)
+    # Rows that already hold the new values are not counted or rewritten
+    change_clause = " OR ".join(f"{column} IS DISTINCT FROM %s" for column in updates)
+    matches = f"user_id = %s AND {' AND '.join(conditions)}"
+    where = f"{matches} AND ({change_clause})"
+    where_params = [user_id, *filter_params, *updates.values()]
+    # Each row keeps the category or subcategory that is not given, the pair it ends up with is checked per row
+    valid = CATEGORY_PAIR_EXISTS if recategorised else "true"
+    valid_params = [updates.get("category"), updates.get("subcategory")] if recategorised else []
+
+    if dry_run:
+        query = f"SELECT COUNT(*), COUNT(*) FILTER (WHERE NOT {valid}) FROM expenses WHERE {where}"
+        params = [*valid_params, *where_params]
+    else:
+        # The LIMIT bounds the work, one row more than the cap tells that the cap was hit. Nothing is written when
+        # a matching row would end up with an unknown pair. The filters are repeated on the UPDATE so its date range
+        # prunes the partitions it plans and locks, an id alone would reach every partition.
+        query = f"""
+            WITH matched AS (
+                SELECT id, {valid} AS valid FROM expenses WHERE {where} LIMIT %s
+            ), updated AS (
+                UPDATE expenses
+                SET {', '.join(f"{column} = %s" for column in updates)}, version = version + 1
+                WHERE id IN (SELECT id FROM matched) AND {matches} AND NOT EXISTS (SELECT 1 FROM matched WHERE NOT valid)
+                RETURNING 1
+            )
+            SELECT (SELECT COUNT(*) FROM updated), (SELECT COUNT(*) FROM matched WHERE NOT valid)
+        """
+        params = [*valid_params, *where_params, max_rows + 1, *updates.values(), user_id, *filter_params]
+
+    try:
+        async with get_conn(user_id) as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, tuple(params))
+                rows_affected, invalid = await cur.fetchone()
+                if not dry_run and rows_affected > max_rows:
+                    await conn.rollback()
+    except Exception as e:
+        raise RuntimeError("Bulk update failed") from e
+    if invalid:
+        raise ValueError(
+            f"{invalid} matching expenses would get a subcategory that is not in their category, nothing was updated. "
+            "Give both category and subcategory, add the pair with add_category or narrow the filters."
+        )
+    if not dry_run and rows_affected > max_rows:
+        raise RuntimeError(f"More than {max_rows} expenses match, nothing was updated. Narrow the filters or raise max_rows.")
+    if not dry_run and rows_affected:
+        invalidate_reads(user_id, all_expenses=True, categories=recategorised, names=recategorised)
+
+    return {"status": "success", "result": {"dry_run": dry_run, "date_range": date_range, "rows_affected": rows_affected}}
+
 @mcp.tool()
-def get_expense(expense_id:int):
+@instrument
+async def bulk_delete_expenses(filters: FiltersSchema, dry_run: bool = False, max_rows: int = 100):
+    """
+    Delete every expense matching the list_expenses filters in one statement.
+    Use dry_run to get only the number of expenses that would be deleted. Fails without deleting anything when more than max_rows match.
+    """
+    check_max_rows(max_rows)
+    date_range = await resolve_dates(filters)
+    conditions, filter_params = build_filter_conditions(filters)
+    user_id = await current_user_id()
+    where = f"user_id = %s AND {' AND '.join(conditions)}"
+    where_params = [user_id, *filter_params]
+
+    if dry_run:
+        query = f"SELECT COUNT(*) FROM expenses WHERE {where}"
+        params = where_params
+    else:
+        # The filters are repeated on the DELETE so its date range prunes the partitions, like in bulk_update_expenses
+        query = f"DELETE FROM expenses WHERE id IN (SELECT id FROM expenses WHERE {where} LIMIT %s) AND {where}"
+        params = [*where_params, max_rows + 1, *where_params]
+
+    try:
+        async with get_conn(user_id) as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, tuple(params))
+                rows_affected = (await cur.fetchone())[0] if dry_run else cur.rowcount
+                if not dry_run and rows_affected > max_rows:
+                    await conn.rollback()
+    except Exception as e:
+        raise RuntimeError("Bulk deletion failed") from e
+    if not dry_run and rows_affected > max_rows:
+        raise RuntimeError(f"More than {max_rows} expenses match, nothing was deleted. Narrow the filters or raise max_rows.")
+    if not dry_run and rows_affected:
+        invalidate_reads(user_id, all_expenses=True)
+
+    return {"status": "success", "result": {"dry_run": dry_run, "date_range": date_range, "rows_affected": rows_affected}}
+
+@mcp.tool()
+@instrument
+async def get_expense(expense_id:int):
     """Get an expense by id"""
-    user_id = get_default_user_id()
-    query = "SELECT expense_date,base_amount,original_amount, category,subcategory,description,currency FROM expenses WHERE user_id = %s AND id = %s;"
+    user_id = await current_user_id()
+    query = "SELECT expense_date,base_amount,original_amount, category,subcategory,description,currency,version,recurring_id FROM expenses WHERE user_id = %s AND id = %s;"
+
+    async def fetch():
+        async with get_conn(user_id) as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, (user_id,expense_id))
+                row = await cur.fetchone() # Get the entire row
+                columns = [desc[0] for desc in cur.description] if row else [] # Read before the cursor closes: (('expense_date', type_code, size...), ('base_amount', ...), ('category', ...))
+        return dict(zip(columns, row)) if row else None # A missing expense is not cached
 
     try:
-        with get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute(query, (user_id,expense_id))
-                row = cur.fetchone() # Get the entire row
+        record = await result_cache.get_or_load(user_id, "expense", expense_id, fetch)
     except Exception as e:
         raise RuntimeError("Runtime error, cannot fetch expense")
-    if row:
-        columns = [desc[0] for desc in cur.description] # (('expense_date', type_code, size...), ('base_amount', ...), ('category', ...))
-        record = dict(zip(columns, row))
+    if record:
         return {
             "status": "success",
             "result":{
@@ -424,22 +1590,112 @@ def get_expense(expense_id:int):
         raise RuntimeError("No such expense record exists")
 
 
-def convert_currency(amount:Decimal, base_currency:str, target_currency:str):
-    """Convert an amount from a target currency to a base currency."""
-    try:
-        response = requests.get(f"https://open.er-api.com/v6/latest/{base_currency}",timeout=5)
-    except requests.exceptions.RequestException as r:
-        raise requests.exceptions.RequestException("Request Failed")
+EXPORT_DIR = os.getenv("EXPORT_DIR", os.path.join(os.path.dirname(__file__), "exports"))
+EXPORT_COLUMNS = ["id", "expense_date", "original_amount", "currency", "base_amount", "category", "subcategory", "description"]
+EXPORT_BATCH_SIZE = 10000
+EXPORT_CHUNK_BYTES = 1 << 20
+
+def user_export_dir(user_id:str)-> str:
+    # Every user has a directory of their own, expense://exports/ only serves files from the callers one
+    return os.path.join(EXPORT_DIR, str(user_id))
 
-    if response.status_code != 200:
-        raise RuntimeError("Bad Request")
+def write_jsonl_batch(f, batch:list[dict]):
+    # Decimals and dates are written as strings so amounts keep their exact value
+    f.writelines(json.dumps(record, default=str) + "\n" for record in batch)
 
-    data = response.json()
+async def write_export(path:str, export_format:str, query:str, params:tuple, user_id:str)-> int:
+    """
+    Stream the rows of query into path batch by batch, returns the number of rows written.
+    Converting and writing a batch runs in a thread so the event loop keeps serving other tools meanwhile.
+    """
+    rows = 0
+    async with get_conn(user_id) as conn:
+        if export_format == "csv":
+            # COPY streams the file straight from the server, the command tag carries the row count.
+            # Its chunks are small, they are written a megabyte at a time.
+            async with conn.cursor() as cur:
+                with open(path, "wb") as f:
+                    chunks, size = [], 0
+                    async with cur.copy(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", params) as copy:
+                        async for data in copy:
+                            chunks.append(data)
+                            size += len(data)
+                            if size >= EXPORT_CHUNK_BYTES:
+                                await asyncio.to_thread(f.writelines, chunks)
+                                chunks, size = [], 0
+                    await asyncio.to_thread(f.writelines, chunks)
+                return cur.rowcount
+
+        # Named cursor keeps the result on the server and hands it over in batches
+        async with conn.cursor(name="export_expenses", row_factory=dict_row) as cur:
+            await cur.execute(query, params)
+            if export_format == "jsonl":
+                with open(path, "w", encoding="utf-8") as f:
+                    while batch := await cur.fetchmany(EXPORT_BATCH_SIZE):
+                        await asyncio.to_thread(write_jsonl_batch, f, batch)
+                        rows += len(batch)
+                return rows
+
+            import pyarrow as pa # Optional dependency, checked by export_expenses_to_file
+            import pyarrow.parquet as pq
+            schema = pa.schema([
+                ("id", pa.int64()), ("expense_date", pa.date32()),
+                ("original_amount", pa.decimal128(10, 2)), ("currency", pa.string()),
+                ("base_amount", pa.decimal128(10, 2)), ("category", pa.string()),
+                ("subcategory", pa.string()), ("description", pa.string()),
+            ])
+            with pq.ParquetWriter(path, schema) as writer:
+                while batch := await cur.fetchmany(EXPORT_BATCH_SIZE):
+                    await asyncio.to_thread(lambda: writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema)))
+                    rows += len(batch)
+    return rows
+
+async def export_expenses_to_file(filters:FiltersSchema, export_format:str, path:Optional[str] = None)-> dict:
+    """Export the expenses matching filters to path, a new file in the users directory of EXPORT_DIR by default."""
+    if export_format == "parquet":
+        try:
+            import pyarrow
+        except ImportError as e:
+            raise RuntimeError("Parquet export needs pyarrow, install it with `uv add pyarrow`") from e
+    date_range = await resolve_dates(filters)
+    conditions, filter_params = build_filter_conditions(filters, require_filter=False)
+    user_id = await current_user_id()
+    query = f"""
+        SELECT {", ".join(EXPORT_COLUMNS)}
+        FROM expenses
+        WHERE user_id = %s {"".join(f" AND {condition}" for condition in conditions)}
+        ORDER BY expense_date, id
+    """
+    if path is None:
+        os.makedirs(user_export_dir(user_id), exist_ok=True)
+        path = os.path.join(user_export_dir(user_id), f"expenses_{datetime.now():%Y%m%d_%H%M%S}_{os.urandom(3).hex()}.{export_format}")
+    # Written under a temporary name so a failed export never leaves a partial file behind
+    partial = f"{path}.part"
     try:
-        rate = data["rates"][target_currency]
-    except KeyError:
-        raise KeyError(f"Currency rate for {target_currency} not found")
-    result = (Decimal(rate) * amount).quantize(Decimal("0.00"), rounding=ROUND_HALF_UP)
+        rows = await write_export(partial, export_format, query, (user_id, *filter_params), user_id)
+        os.replace(partial, path)
+    except Exception as e:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise RuntimeError("Failed to export expenses") from e
+    return {"path": os.path.abspath(path), "format": export_format, "date_range": date_range, "rows": rows, "bytes": os.path.getsize(path)}
+
+@mcp.tool()
+@instrument
+async def export_expenses(filters: Optional[FiltersSchema] = None, format: Literal["csv", "jsonl", "parquet"] = "csv"):
+    """
+    Export all expenses matching the filters to a CSV, JSONL or Parquet file on the server.
+    Returns the file path and an expense://exports/ resource URI instead of the rows, use it for full exports and handoffs.
+    """
+    result = await export_expenses_to_file(filters or FiltersSchema(), format)
+    result["uri"] = f"expense://exports/{os.path.basename(result['path'])}"
+    return {"status": "success", "result": result}
+
+
+async def convert_currency(amount:Decimal, base_currency:str, target_currency:str, on_date:Optional[date] = None):
+    """Convert an amount from a target currency to a base currency at the rate of on_date, today when not given."""
+    rate = await get_rate_on(base_currency, target_currency, on_date)
+    result = (rate * amount).quantize(Decimal("0.00"), rounding=ROUND_HALF_UP)
     return {
         "status":"success",
         "result":result
@@ -452,5 +1708,27 @@ def categories():
     with open(CATEGORIES_PATH,"r",encoding="utf-8") as f:
         return f.read()
 
+@mcp.resource("expense://exports/{name}")
+async def exports(name:str):
+    # Files written by export_expenses, only plain names inside the export directory of the caller are served
+    path = os.path.join(user_export_dir(await current_user_id()), name)
+    if os.path.basename(name) != name or name.endswith(".part") or not os.path.isfile(path):
+        raise ValueError(f"No such export: {name}")
+    if name.endswith(".parquet"):
+        with open(path, "rb") as f:
+            return f.read()
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+@mcp.resource("expense://stats",mime_type="application/json")
+def stats():
+    # Runtime counters of the server, e.g. connection pool checkouts and rate cache hits
+    return json.dumps({"pool": pool_stats(), "fx_cache": rate_cache.stats(), "result_cache": result_cache.stats(), "slow_queries": list(metrics.slow_queries)})
+
+@mcp.resource("expense://metrics",mime_type="text/plain")
+def prometheus_metrics():
+    # Tool call counts, latency, stage timing and row histograms in the Prometheus text format
+    return metrics.render()
+
 if __name__ == "__main__":
     mcp.run()
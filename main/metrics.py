@@ -0,0 +1,224 @@
+import os,re,sys,time
+from collections import deque
+from contextvars import ContextVar
+from functools import wraps
+from psycopg import AsyncCursor,AsyncServerCursor
+from cache import result_cache
+
+# Per tool call counts, latencies, stage timings and rows returned, rendered in the Prometheus text format by the
+# expense://metrics resource. Stages are timed where the work happens (get_conn, query, fx, ...) and are labelled
+# with the tool that is running through a context variable, queries slower than SLOW_QUERY_MS are logged with their
+# SQL. The result cache counters are read from the cache when rendering. METRICS_ENABLED=false leaves the tools undecorated, the cursors plain and every stage a shared no-op.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() not in ("0", "false", "no")
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "500"))
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROW_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+_current_tool = ContextVar("current_tool", default="none")
+
+
+class Metrics:
+    """Counters, gauges and histograms keyed by metric name and a tuple of label pairs."""
+
+    def __init__(self):
+        self._counters = {} # (name, labels) -> value
+        self._collected = {} # (name, labels) -> function returning the value, read when rendering
+        self._histograms = {} # (name, labels) -> [bucket counts..., +Inf count, sum]
+        self._buckets = {}
+        self._help = {}
+        self.slow_queries = deque(maxlen=50)
+
+    def describe(self, name:str, kind:str, help_text:str, buckets:tuple = ()):
+        self._help[name] = (kind, help_text)
+        if buckets:
+            self._buckets[name] = buckets
+
+    def inc(self, name:str, labels:tuple, value:float = 1):
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def collect(self, name:str, labels:tuple, read):
+        """Render the value read() returns, for counters and gauges another component already keeps."""
+        self._collected[(name, labels)] = read
+
+    def observe(self, name:str, labels:tuple, value:float):
+        buckets = self._buckets[name]
+        key = (name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = [0] * (len(buckets) + 2)
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[i] += 1
+                break
+        else:
+            histogram[len(buckets)] += 1
+        histogram[-1] += value
+
+    def render(self)-> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, (kind, help_text) in self._help.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind in ("counter", "gauge"):
+                for (metric, labels), value in self._counters.items():
+                    if metric == name:
+                        lines.append(f"{name}{format_labels(labels)} {value:g}")
+                for (metric, labels), read in self._collected.items():
+                    if metric == name:
+                        lines.append(f"{name}{format_labels(labels)} {read():g}")
+                continue
+            for (metric, labels), histogram in self._histograms.items():
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self._buckets[name], histogram):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', f'{bound:g}'),))} {cumulative}")
+                cumulative += histogram[-2]
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram[-1]:.6f}")
+                lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels:tuple)-> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+metrics = Metrics()
+metrics.describe("expense_tool_calls_total", "counter", "Tool calls by tool and outcome")
+metrics.describe("expense_tool_duration_seconds", "histogram", "Tool call latency", DURATION_BUCKETS)
+metrics.describe("expense_tool_stage_seconds", "histogram", "Time spent in a stage of a tool call", DURATION_BUCKETS)
+metrics.describe("expense_tool_rows", "histogram", "Rows or records returned by a tool call", ROW_BUCKETS)
+metrics.describe("expense_slow_queries_total", "counter", f"Queries slower than SLOW_QUERY_MS ({SLOW_QUERY_MS:g} ms)")
+metrics.describe("expense_result_cache_events_total", "counter", "Result cache hits, misses, evictions and invalidations")
+metrics.describe("expense_result_cache_entries", "gauge", "Entries in the result cache")
+metrics.describe("expense_result_cache_hit_ratio", "gauge", "Result cache hits over lookups since start")
+for event in ("hits", "misses", "evictions", "invalidations"):
+    metrics.collect("expense_result_cache_events_total", (("event", event),), lambda event=event: result_cache.stats()[event])
+metrics.collect("expense_result_cache_entries", (), lambda: result_cache.stats()["size"])
+metrics.collect("expense_result_cache_hit_ratio", (), lambda: result_cache.stats()["hit_rate"])
+
+
+def observe_stage(stage:str, started:float):
+    """Record the time since started as a stage of the running tool."""
+    if METRICS_ENABLED:
+        metrics.observe("expense_tool_stage_seconds", (("tool", _current_tool.get()), ("stage", stage)), time.perf_counter() - started)
+
+
+class _Stage:
+    __slots__ = ("name", "started")
+
+    def __init__(self, name:str):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe_stage(self.name, self.started)
+        return False
+
+
+class _NoStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_STAGE = _NoStage()
+
+def stage(name:str):
+    """Context manager timing a stage of the running tool, e.g. with stage("validation"): ..."""
+    return _Stage(name) if METRICS_ENABLED else _NO_STAGE
+
+
+def result_rows(response)-> int | None:
+    """Rows a tool response carries, None for responses that are not row sets."""
+    if not isinstance(response, dict) or not isinstance(response.get("result"), dict):
+        return None
+    result = response["result"]
+    for key in ("records", "rows", "rules", "budgets", "categories"):
+        if isinstance(result.get(key), (list, dict)):
+            return len(result[key])
+    return None
+
+
+def instrument(func):
+    """Count and time every call of an async tool, put it below @mcp.tool() so FastMCP registers the wrapper."""
+    if not METRICS_ENABLED:
+        return func
+    name = func.__name__
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        token = _current_tool.set(name)
+        started = time.perf_counter()
+        status = "error"
+        try:
+            response = await func(*args, **kwargs)
+            status = "ok"
+            rows = result_rows(response)
+            if rows is not None:
+                metrics.observe("expense_tool_rows", (("tool", name),), rows)
+            return response
+        finally:
+            metrics.observe("expense_tool_duration_seconds", (("tool", name),), time.perf_counter() - started)
+            metrics.inc("expense_tool_calls_total", (("tool", name), ("status", status)))
+            _current_tool.reset(token)
+    return wrapper
+
+
+def record_query(query, started:float):
+    """Time a query as the query stage and log it when it is slower than SLOW_QUERY_MS."""
+    observe_stage("query", started)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if elapsed_ms >= SLOW_QUERY_MS:
+        sql = re.sub(r"\s+", " ", query if isinstance(query, str) else str(query)).strip()
+        tool = _current_tool.get()
+        metrics.inc("expense_slow_queries_total", (("tool", tool),))
+        metrics.slow_queries.append({"tool": tool, "ms": round(elapsed_ms, 1), "sql": sql})
+        print(f"Slow query in {tool} ({elapsed_ms:.1f} ms): {sql}", file=sys.stderr)
+
+
+class TimedCursor(AsyncCursor):
+    """Client side cursor that times execute, the rows arrive with it so this covers the whole query."""
+
+    async def execute(self, query, params = None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            record_query(query, started)
+
+
+class TimedServerCursor(AsyncServerCursor):
+    """Named cursor that times the DECLARE and every fetch, most of the work of a named cursor happens in the fetches."""
+
+    async def execute(self, query, params = None, **kwargs):
+        self._timed_query = query
+        started = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            record_query(query, started)
+
+    async def fetchmany(self, size:int = 0):
+        started = time.perf_counter()
+        try:
+            return await super().fetchmany(size)
+        finally:
+            record_query(self._timed_query, started)
+
+
+async def configure_connection(conn):
+    """Pool configure hook installing the timed cursors on every new connection."""
+    conn.cursor_factory = TimedCursor
+    conn.server_cursor_factory = TimedServerCursor
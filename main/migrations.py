@@ -0,0 +1,823 @@
+import sys,os,json
+from init_db import get_conn
+
+CATEGORIES_PATH = os.path.join(os.path.dirname(__file__), "categories.json")
+
+# expenses is range partitioned on expense_date. The interval is fixed when the table is first partitioned,
+# the number of future partitions kept ready can be changed at any time.
+PARTITION_INTERVAL = os.getenv("EXPENSES_PARTITION_INTERVAL", "year").strip().lower()
+PARTITION_PREMAKE = int(os.getenv("EXPENSES_PARTITION_PREMAKE", "2"))
+
+# First month of the fiscal year used by the fy period filters, April by default. calendar_periods is filled again
+# on the next startup or migrate after it changes.
+FISCAL_YEAR_START_MONTH = int(os.getenv("FISCAL_YEAR_START_MONTH", "4"))
+
+
+async def seed_user_categories(conn, user_id:str | None = None):
+    """Add the default categories of categories.json to the category list of one user, or of every user."""
+    with open(CATEGORIES_PATH, "r", encoding="utf-8") as f:
+        defaults = json.load(f)
+    pairs = [(category, "") for category in defaults] + [(category, sub) for category, subs in defaults.items() for sub in subs]
+    await conn.execute(
+        """
+        INSERT INTO user_categories (user_id, category, subcategory)
+        SELECT u.id, c.category, c.subcategory
+        FROM users u CROSS JOIN unnest(%s::text[], %s::text[]) AS c(category, subcategory)
+        WHERE %s::uuid IS NULL OR u.id = %s::uuid
+        ON CONFLICT (user_id, category, subcategory) DO NOTHING
+        """,
+        ([category for category, _ in pairs], [sub for _, sub in pairs], user_id, user_id)
+    )
+
+# Operators of the conditions expense reads add next to the user_id one: amount filters and keyset paging (numeric),
+# full text search, and with pg_trgm the trigram search over expense_search_text. Below a row level security policy
+# Postgres only uses conditions with leakproof operators in an index, the rest are checked row by row after it.
+# None of these can raise an error that reveals a row, marking them takes a superuser.
+LEAKPROOF_FUNCTIONS = [
+    "numeric_eq(numeric, numeric)", "numeric_ne(numeric, numeric)", "numeric_lt(numeric, numeric)",
+    "numeric_le(numeric, numeric)", "numeric_gt(numeric, numeric)", "numeric_ge(numeric, numeric)",
+    "ts_match_vq(tsvector, tsquery)",
+]
+TRIGRAM_LEAKPROOF_FUNCTIONS = ["textcat(text, text)", "replace(text, text, text)", "word_similarity_commutator_op(text, text)"]
+
+async def ensure_leakproof(conn)-> int:
+    """
+    Mark LEAKPROOF_FUNCTIONS, and TRIGRAM_LEAKPROOF_FUNCTIONS with pg_trgm, leakproof when the role is a superuser, otherwise warn with the statements to run.
+    Returns how many were marked.
+    """
+    async with conn.cursor() as cur:
+        await cur.execute(
+            """
+            SELECT p.oid::regprocedure::text
+            FROM unnest(%s::text[] || CASE WHEN EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN %s::text[] END) AS f(signature)
+            JOIN pg_proc p ON p.oid = to_regprocedure(f.signature)
+            WHERE NOT p.proleakproof
+            """,
+            (LEAKPROOF_FUNCTIONS, TRIGRAM_LEAKPROOF_FUNCTIONS)
+        )
+        missing = [row[0] for row in await cur.fetchall()]
+        if not missing:
+            return 0
+        await cur.execute("SELECT rolsuper FROM pg_roles WHERE rolname = current_user")
+        if not (await cur.fetchone())[0]:
+            print(
+                "Expense reads are checked by row level security, amount, paging and search conditions are not served "
+                "by the indexes until a superuser runs: " + " ".join(f"ALTER FUNCTION {function} LEAKPROOF;" for function in missing),
+                file=sys.stderr
+            )
+            return 0
+        for function in missing:
+            await cur.execute(f"ALTER FUNCTION {function} LEAKPROOF")
+    return len(missing)
+
+async def ensure_calendar(conn)-> int:
+    """Fill calendar_periods when it is empty or FISCAL_YEAR_START_MONTH changed, returns the rows written."""
+    if not 1 <= FISCAL_YEAR_START_MONTH <= 12:
+        raise ValueError("FISCAL_YEAR_START_MONTH must be 1 to 12")
+    async with conn.cursor() as cur:
+        await cur.execute("SELECT extract(month FROM start_date)::int FROM calendar_periods WHERE period = 'fy2000'")
+        row = await cur.fetchone()
+        if row and row[0] == FISCAL_YEAR_START_MONTH:
+            return 0
+        await cur.execute("SELECT fill_calendar_periods(%s)", (FISCAL_YEAR_START_MONTH,))
+        return (await cur.fetchone())[0]
+
+async def save_partition_interval(conn):
+    if PARTITION_INTERVAL not in ("month", "year"):
+        raise ValueError("EXPENSES_PARTITION_INTERVAL must be month or year")
+    await conn.execute(
+        "INSERT INTO partition_settings (table_name, partition_interval) VALUES ('expenses', %s) ON CONFLICT (table_name) DO NOTHING",
+        (PARTITION_INTERVAL,)
+    )
+
+
+# Versioned schema migrations. Each entry is (version, name, statements) and is applied once in order, the applied
+# versions are recorded in schema_version. A statement is SQL or an async callable taking the connection. Never edit a released migration, append a new one instead.
+# The statements of the first migrations are idempotent because databases created before versioning already have them.
+MIGRATIONS = [
+    (1, "users and expenses", [
+        # Users table
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id UUID PRIMARY KEY,
+            email TEXT NOT NULL UNIQUE CHECK (email ~* '^[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\\.[A-Za-z]{2,}$'),
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """,
+        # Initialize Local User
+        """
+        INSERT INTO users (id, email)
+        VALUES (
+            '00000000-0000-0000-0000-000000000001',
+            'local@expense.tracker'
+        )
+        ON CONFLICT (id) DO NOTHING;
+        """,
+        # Expenses table
+        """
+        CREATE TABLE IF NOT EXISTS expenses (
+            id SERIAL PRIMARY KEY,
+            user_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            expense_date DATE NOT NULL,
+            original_amount NUMERIC(10,2) NOT NULL CHECK (original_amount > 0),
+            currency CHAR(3) NOT NULL,
+            base_amount NUMERIC(10,2) NOT NULL CHECK (base_amount > 0),
+            category TEXT NOT NULL,
+            subcategory TEXT,
+            description TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()              
+        );
+        """,
+        # Index for faster queries
+        """
+        CREATE INDEX IF NOT EXISTS idx_expenses_user_category
+        ON expenses (user_id, category);
+
+        CREATE INDEX IF NOT EXISTS idx_expenses_user_date
+        ON expenses (user_id, expense_date);
+
+        CREATE INDEX IF NOT EXISTS idx_expenses_user_date_category
+        ON expenses (user_id, expense_date, category);
+
+        CREATE INDEX IF NOT EXISTS idx_expenses_user_keyset
+        ON expenses (user_id, expense_date DESC, base_amount DESC, id DESC);
+        """,
+    ]),
+    (2, "monthly rollup", [
+        # Monthly rollup of expenses so summaries do not scan the expenses table
+        """
+        CREATE TABLE IF NOT EXISTS expense_monthly_rollup (
+            user_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            month DATE NOT NULL,
+            category TEXT NOT NULL,
+            subcategory TEXT NOT NULL DEFAULT '',
+            currency CHAR(3) NOT NULL,
+            total_base NUMERIC(16,2) NOT NULL DEFAULT 0,
+            total_original NUMERIC(16,2) NOT NULL DEFAULT 0,
+            expense_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, month, category, subcategory, currency)
+        );
+        """,
+        # Backfill once from the existing expenses, the triggers below keep it current afterwards
+        """
+        INSERT INTO expense_monthly_rollup (user_id, month, category, subcategory, currency, total_base, total_original, expense_count)
+        SELECT user_id, date_trunc('month', expense_date)::date, category, COALESCE(subcategory, ''), currency,
+               SUM(base_amount), SUM(original_amount), COUNT(*)
+        FROM expenses
+        WHERE NOT EXISTS (SELECT 1 FROM expense_monthly_rollup)
+        GROUP BY 1, 2, 3, 4, 5;
+        """,
+        # Statement level triggers with transition tables apply one aggregated upsert per statement,
+        # so bulk loads do not pay a rollup write per row
+        """
+        CREATE OR REPLACE FUNCTION expenses_rollup_sync() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            -- Transition tables only exist for their own event, plpgsql plans a branch only when it runs
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO expense_monthly_rollup AS r (user_id, month, category, subcategory, currency, total_base, total_original, expense_count)
+                SELECT user_id, date_trunc('month', expense_date)::date, category, COALESCE(subcategory, ''), currency,
+                       SUM(base_amount), SUM(original_amount), COUNT(*)
+                FROM new_rows
+                GROUP BY 1, 2, 3, 4, 5
+                ON CONFLICT (user_id, month, category, subcategory, currency) DO UPDATE
+                SET total_base = r.total_base + EXCLUDED.total_base,
+                    total_original = r.total_original + EXCLUDED.total_original,
+                    expense_count = r.expense_count + EXCLUDED.expense_count;
+            ELSIF TG_OP = 'DELETE' THEN
+                UPDATE expense_monthly_rollup AS r
+                SET total_base = r.total_base - d.total_base,
+                    total_original = r.total_original - d.total_original,
+                    expense_count = r.expense_count - d.expense_count
+                FROM (
+                    SELECT user_id, date_trunc('month', expense_date)::date AS month, category, COALESCE(subcategory, '') AS subcategory, currency,
+                           SUM(base_amount) AS total_base, SUM(original_amount) AS total_original, COUNT(*) AS expense_count
+                    FROM old_rows
+                    GROUP BY 1, 2, 3, 4, 5
+                ) AS d
+                WHERE (r.user_id, r.month, r.category, r.subcategory, r.currency) = (d.user_id, d.month, d.category, d.subcategory, d.currency);
+            ELSE
+                -- Old and new versions can fall in the same bucket, so net them out before the upsert
+                INSERT INTO expense_monthly_rollup AS r (user_id, month, category, subcategory, currency, total_base, total_original, expense_count)
+                SELECT user_id, date_trunc('month', expense_date)::date, category, COALESCE(subcategory, ''), currency,
+                       SUM(sign * base_amount), SUM(sign * original_amount), SUM(sign)
+                FROM (
+                    SELECT 1 AS sign, user_id, expense_date, category, subcategory, currency, base_amount, original_amount FROM new_rows
+                    UNION ALL
+                    SELECT -1, user_id, expense_date, category, subcategory, currency, base_amount, original_amount FROM old_rows
+                ) AS changes
+                GROUP BY 1, 2, 3, 4, 5
+                ON CONFLICT (user_id, month, category, subcategory, currency) DO UPDATE
+                SET total_base = r.total_base + EXCLUDED.total_base,
+                    total_original = r.total_original + EXCLUDED.total_original,
+                    expense_count = r.expense_count + EXCLUDED.expense_count;
+            END IF;
+            RETURN NULL;
+        END;
+        $$;
+
+        -- A trigger with transition tables can only have one event
+        DROP TRIGGER IF EXISTS expenses_rollup_insert ON expenses;
+        CREATE TRIGGER expenses_rollup_insert AFTER INSERT ON expenses
+        REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION expenses_rollup_sync();
+
+        DROP TRIGGER IF EXISTS expenses_rollup_update ON expenses;
+        CREATE TRIGGER expenses_rollup_update AFTER UPDATE ON expenses
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION expenses_rollup_sync();
+
+        DROP TRIGGER IF EXISTS expenses_rollup_delete ON expenses;
+        CREATE TRIGGER expenses_rollup_delete AFTER DELETE ON expenses
+        REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION expenses_rollup_sync();
+        """,
+    ]),
+    (3, "budgets", [
+        # Budgets with running spend counters per budget period
+        """
+        CREATE TABLE IF NOT EXISTS budgets (
+            id SERIAL PRIMARY KEY,
+            user_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            category TEXT NOT NULL,
+            subcategory TEXT NOT NULL DEFAULT '', -- Empty means the budget covers the whole category
+            period TEXT NOT NULL CHECK (period IN ('monthly', 'quarterly', 'half_yearly', 'yearly')),
+            amount NUMERIC(12,2) NOT NULL CHECK (amount > 0),
+            alert_threshold NUMERIC(4,3) NOT NULL DEFAULT 0.8 CHECK (alert_threshold > 0 AND alert_threshold <= 1),
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            UNIQUE (user_id, category, subcategory, period)
+        );
+
+        CREATE TABLE IF NOT EXISTS budget_spend (
+            budget_id INTEGER NOT NULL REFERENCES budgets(id) ON DELETE CASCADE,
+            period_start DATE NOT NULL,
+            spent NUMERIC(16,2) NOT NULL DEFAULT 0,
+            PRIMARY KEY (budget_id, period_start)
+        );
+
+        CREATE OR REPLACE FUNCTION budget_period_start(period TEXT, day DATE) RETURNS DATE IMMUTABLE LANGUAGE sql AS $$
+            SELECT CASE period
+                WHEN 'monthly' THEN date_trunc('month', day)::date
+                WHEN 'quarterly' THEN date_trunc('quarter', day)::date
+                WHEN 'half_yearly' THEN make_date(extract(year FROM day)::int, CASE WHEN extract(month FROM day) <= 6 THEN 1 ELSE 7 END, 1)
+                ELSE date_trunc('year', day)::date
+            END;
+        $$;
+
+        -- Every budget period is made of whole months, so the spend counters follow the monthly rollup deltas.
+        -- The rollup is written once per statement and bucket, which keeps this row trigger cheap even for bulk loads.
+        CREATE OR REPLACE FUNCTION rollup_budget_sync() RETURNS trigger LANGUAGE plpgsql AS $$
+        DECLARE
+            delta NUMERIC := NEW.total_base - CASE WHEN TG_OP = 'UPDATE' THEN OLD.total_base ELSE 0 END;
+        BEGIN
+            IF delta <> 0 THEN
+                INSERT INTO budget_spend AS s (budget_id, period_start, spent)
+                SELECT b.id, budget_period_start(b.period, NEW.month), delta
+                FROM budgets b
+                WHERE b.user_id = NEW.user_id AND b.category = NEW.category AND b.subcategory IN ('', NEW.subcategory)
+                ON CONFLICT (budget_id, period_start) DO UPDATE SET spent = s.spent + EXCLUDED.spent;
+            END IF;
+            RETURN NULL;
+        END;
+        $$;
+
+        DROP TRIGGER IF EXISTS rollup_budget_sync ON expense_monthly_rollup;
+        CREATE TRIGGER rollup_budget_sync AFTER INSERT OR UPDATE OF total_base ON expense_monthly_rollup
+        FOR EACH ROW EXECUTE FUNCTION rollup_budget_sync();
+        """,
+    ]),
+    (4, "expense versions", [
+        # Row version for optimistic locking, bumped by every update_expense
+        """
+        ALTER TABLE expenses ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+        """,
+    ]),
+    (5, "expense search", [
+        # One text per expense for search_expenses, underscores of category names become spaces so 'dining_out' matches 'dining'
+        """
+        CREATE OR REPLACE FUNCTION expense_search_text(description TEXT, category TEXT, subcategory TEXT) RETURNS TEXT
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT COALESCE(description, '') || ' ' || replace(category, '_', ' ') || ' ' || COALESCE(replace(subcategory, '_', ' '), '')
+        $$;
+        """,
+        # Full text on the 'simple' config, no stemming or stop words since descriptions are short merchant like strings
+        """
+        ALTER TABLE expenses ADD COLUMN IF NOT EXISTS search_vector TSVECTOR
+        GENERATED ALWAYS AS (to_tsvector('simple'::regconfig, expense_search_text(description, category, subcategory))) STORED;
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_expenses_search_vector ON expenses USING GIN (search_vector);
+        """,
+        # Typo tolerant matching needs pg_trgm from contrib, without it search_expenses falls back to full text only
+        """
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+                CREATE EXTENSION IF NOT EXISTS pg_trgm;
+                CREATE INDEX IF NOT EXISTS idx_expenses_search_trgm ON expenses
+                USING GIN (expense_search_text(description, category, subcategory) gin_trgm_ops);
+            ELSE
+                RAISE NOTICE 'pg_trgm is not available, expense search will not match misspellings';
+            END IF;
+        END;
+        $$;
+        """,
+    ]),
+    (6, "fx rate history", [
+        # 1 USD = rate currency per day, the key order serves the latest rate on or before a date for a currency
+        """
+        CREATE TABLE IF NOT EXISTS fx_rates (
+            currency TEXT NOT NULL,
+            rate_date DATE NOT NULL,
+            rate NUMERIC NOT NULL CHECK (rate > 0),
+            PRIMARY KEY (currency, rate_date)
+        );
+        """,
+    ]),
+    (7, "user categories", [
+        # Category names are lowercase with underscores for spaces and hyphens from now on, older rows are renamed to match.
+        # The budget counter trigger is paused meanwhile and the counters are rebuilt from the rollup afterwards, since
+        # renamed expenses and renamed budgets would otherwise count twice or not at all.
+        """
+        ALTER TABLE expense_monthly_rollup DISABLE TRIGGER rollup_budget_sync;
+
+        UPDATE expenses
+        SET category = regexp_replace(lower(category), '[[:space:]-]+', '_', 'g'),
+            subcategory = regexp_replace(lower(subcategory), '[[:space:]-]+', '_', 'g')
+        WHERE category ~ '[[:space:]-]' OR subcategory ~ '[[:space:]-]';
+
+        UPDATE budgets b
+        SET category = regexp_replace(lower(b.category), '[[:space:]-]+', '_', 'g'),
+            subcategory = regexp_replace(lower(b.subcategory), '[[:space:]-]+', '_', 'g')
+        WHERE (b.category ~ '[[:space:]-]' OR b.subcategory ~ '[[:space:]-]')
+        AND NOT EXISTS (
+            SELECT 1 FROM budgets o
+            WHERE o.user_id = b.user_id AND o.period = b.period
+            AND o.category = regexp_replace(lower(b.category), '[[:space:]-]+', '_', 'g')
+            AND o.subcategory = regexp_replace(lower(b.subcategory), '[[:space:]-]+', '_', 'g')
+        );
+
+        ALTER TABLE expense_monthly_rollup ENABLE TRIGGER rollup_budget_sync;
+
+        DELETE FROM budget_spend;
+        INSERT INTO budget_spend (budget_id, period_start, spent)
+        SELECT b.id, budget_period_start(b.period, r.month), SUM(r.total_base)
+        FROM budgets b
+        JOIN expense_monthly_rollup r ON r.user_id = b.user_id AND r.category = b.category AND b.subcategory IN ('', r.subcategory)
+        GROUP BY 1, 2;
+        """,
+        # Category list of every user, an empty subcategory is the category itself
+        """
+        CREATE TABLE IF NOT EXISTS user_categories (
+            user_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            category TEXT NOT NULL,
+            subcategory TEXT NOT NULL DEFAULT '',
+            usage_count INTEGER NOT NULL DEFAULT 0,
+            last_used DATE,
+            PRIMARY KEY (user_id, category, subcategory)
+        );
+        """,
+        # Usage counters follow the expenses per statement like the monthly rollup. The trigger is created before the
+        # backfill, its lock on expenses keeps writers out until this migration commits so no expense is counted twice.
+        """
+        CREATE OR REPLACE FUNCTION expenses_category_sync() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO user_categories AS c (user_id, category, subcategory, usage_count, last_used)
+                SELECT user_id, category, COALESCE(subcategory, ''), COUNT(*), MAX(expense_date)
+                FROM new_rows
+                GROUP BY 1, 2, 3
+                ON CONFLICT (user_id, category, subcategory) DO UPDATE
+                SET usage_count = c.usage_count + EXCLUDED.usage_count, last_used = GREATEST(c.last_used, EXCLUDED.last_used);
+            ELSIF TG_OP = 'DELETE' THEN
+                UPDATE user_categories AS c
+                SET usage_count = c.usage_count - d.usage_count
+                FROM (
+                    SELECT user_id, category, COALESCE(subcategory, '') AS subcategory, COUNT(*) AS usage_count
+                    FROM old_rows
+                    GROUP BY 1, 2, 3
+                ) AS d
+                WHERE (c.user_id, c.category, c.subcategory) = (d.user_id, d.category, d.subcategory);
+            ELSE
+                -- Only recategorised expenses move a count, updates of other columns net out and write nothing
+                INSERT INTO user_categories AS c (user_id, category, subcategory, usage_count, last_used)
+                SELECT user_id, category, COALESCE(subcategory, ''), SUM(sign), MAX(expense_date) FILTER (WHERE sign = 1)
+                FROM (
+                    SELECT 1 AS sign, user_id, category, subcategory, expense_date FROM new_rows
+                    UNION ALL
+                    SELECT -1, user_id, category, subcategory, expense_date FROM old_rows
+                ) AS changes
+                GROUP BY 1, 2, 3
+                HAVING SUM(sign) <> 0
+                ON CONFLICT (user_id, category, subcategory) DO UPDATE
+                SET usage_count = c.usage_count + EXCLUDED.usage_count, last_used = GREATEST(c.last_used, EXCLUDED.last_used);
+            END IF;
+            RETURN NULL;
+        END;
+        $$;
+
+        DROP TRIGGER IF EXISTS expenses_category_insert ON expenses;
+        CREATE TRIGGER expenses_category_insert AFTER INSERT ON expenses
+        REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION expenses_category_sync();
+
+        DROP TRIGGER IF EXISTS expenses_category_update ON expenses;
+        CREATE TRIGGER expenses_category_update AFTER UPDATE ON expenses
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION expenses_category_sync();
+
+        DROP TRIGGER IF EXISTS expenses_category_delete ON expenses;
+        CREATE TRIGGER expenses_category_delete AFTER DELETE ON expenses
+        REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION expenses_category_sync();
+        """,
+        # Backfill from the expenses, every used category also gets its own entry
+        """
+        INSERT INTO user_categories (user_id, category, subcategory, usage_count, last_used)
+        SELECT user_id, category, COALESCE(subcategory, ''), COUNT(*), MAX(expense_date)
+        FROM expenses
+        GROUP BY 1, 2, 3
+        ON CONFLICT (user_id, category, subcategory) DO NOTHING;
+
+        INSERT INTO user_categories (user_id, category)
+        SELECT DISTINCT user_id, category FROM expenses
+        ON CONFLICT (user_id, category, subcategory) DO NOTHING;
+        """,
+        seed_user_categories,
+    ]),
+    (8, "partition expenses", [
+        """
+        CREATE TABLE IF NOT EXISTS partition_settings (
+            table_name TEXT PRIMARY KEY,
+            partition_interval TEXT NOT NULL CHECK (partition_interval IN ('month', 'year'))
+        );
+        """,
+        save_partition_interval,
+        # Creates the missing partitions covering from_date to to_date and the default partition. Rows that landed in
+        # the default partition for a new range are moved into it, straight between the partitions so the statement
+        # triggers of expenses do not count them again.
+        """
+        CREATE OR REPLACE FUNCTION ensure_expense_partitions(from_date DATE, to_date DATE) RETURNS INTEGER LANGUAGE plpgsql AS $$
+        DECLARE
+            step TEXT;
+            start_date DATE;
+            end_date DATE;
+            partition_name TEXT;
+            columns TEXT;
+            created INTEGER := 0;
+        BEGIN
+            SELECT partition_interval INTO step FROM partition_settings WHERE table_name = 'expenses';
+            IF to_regclass('expenses_default') IS NULL THEN
+                CREATE TABLE expenses_default PARTITION OF expenses DEFAULT;
+            END IF;
+            start_date := date_trunc(step, from_date)::date;
+            WHILE start_date <= to_date LOOP
+                end_date := (start_date + ('1 ' || step)::interval)::date;
+                partition_name := 'expenses_' || to_char(start_date, CASE step WHEN 'month' THEN '"y"YYYY"m"MM' ELSE '"y"YYYY' END);
+                IF to_regclass(partition_name) IS NULL THEN
+                    IF EXISTS (SELECT 1 FROM expenses_default WHERE expense_date >= start_date AND expense_date < end_date) THEN
+                        SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum) INTO columns
+                        FROM pg_attribute
+                        WHERE attrelid = 'expenses'::regclass AND attnum > 0 AND NOT attisdropped AND attgenerated = '';
+                        EXECUTE format('CREATE TEMP TABLE expenses_moving ON COMMIT DROP AS SELECT %s FROM expenses_default LIMIT 0', columns);
+                        EXECUTE format(
+                            'WITH moved AS (DELETE FROM expenses_default WHERE expense_date >= %L AND expense_date < %L RETURNING %s) INSERT INTO expenses_moving SELECT * FROM moved',
+                            start_date, end_date, columns
+                        );
+                        EXECUTE format('CREATE TABLE %I PARTITION OF expenses FOR VALUES FROM (%L) TO (%L)', partition_name, start_date, end_date);
+                        EXECUTE format('INSERT INTO %I (%s) SELECT %s FROM expenses_moving', partition_name, columns, columns);
+                        DROP TABLE expenses_moving;
+                    ELSE
+                        EXECUTE format('CREATE TABLE %I PARTITION OF expenses FOR VALUES FROM (%L) TO (%L)', partition_name, start_date, end_date);
+                    END IF;
+                    created := created + 1;
+                END IF;
+                start_date := end_date;
+            END LOOP;
+            RETURN created;
+        END;
+        $$;
+        """,
+        # Swap the plain table for a partitioned one. The primary key has to include the partition key, the ids keep
+        # coming from the same sequence. Partitions are filled before the indexes and triggers exist, so the copy
+        # neither maintains indexes row by row nor counts the expenses into the rollups a second time.
+        """
+        LOCK TABLE expenses IN ACCESS EXCLUSIVE MODE;
+        ALTER SEQUENCE expenses_id_seq OWNED BY NONE;
+        ALTER TABLE expenses RENAME TO expenses_unpartitioned;
+
+        CREATE TABLE expenses (
+            id INTEGER NOT NULL DEFAULT nextval('expenses_id_seq'),
+            user_id UUID NOT NULL CONSTRAINT expenses_user_id_fkey REFERENCES users(id) ON DELETE CASCADE,
+            expense_date DATE NOT NULL,
+            original_amount NUMERIC(10,2) NOT NULL CONSTRAINT expenses_original_amount_check CHECK (original_amount > 0),
+            currency CHAR(3) NOT NULL,
+            base_amount NUMERIC(10,2) NOT NULL CONSTRAINT expenses_base_amount_check CHECK (base_amount > 0),
+            category TEXT NOT NULL,
+            subcategory TEXT,
+            description TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            version INTEGER NOT NULL DEFAULT 1,
+            search_vector TSVECTOR GENERATED ALWAYS AS (to_tsvector('simple'::regconfig, expense_search_text(description, category, subcategory))) STORED
+        ) PARTITION BY RANGE (expense_date);
+        ALTER SEQUENCE expenses_id_seq OWNED BY expenses.id;
+
+        SELECT ensure_expense_partitions(COALESCE((SELECT MIN(expense_date) FROM expenses_unpartitioned), CURRENT_DATE), CURRENT_DATE);
+
+        INSERT INTO expenses (id, user_id, expense_date, original_amount, currency, base_amount, category, subcategory, description, created_at, version)
+        SELECT id, user_id, expense_date, original_amount, currency, base_amount, category, subcategory, description, created_at, version
+        FROM expenses_unpartitioned;
+
+        DROP TABLE expenses_unpartitioned;
+        """,
+        # Two btree indexes instead of four: the keyset index also serves user and date range filters, the category
+        # index serves category filters with or without a date range. Partition pruning narrows both to the dates asked for.
+        """
+        ALTER TABLE expenses ADD PRIMARY KEY (id, expense_date);
+        CREATE INDEX idx_expenses_user_keyset ON expenses (user_id, expense_date DESC, base_amount DESC, id DESC);
+        CREATE INDEX idx_expenses_user_category_date ON expenses (user_id, category, expense_date);
+        CREATE INDEX idx_expenses_search_vector ON expenses USING GIN (search_vector);
+
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+                CREATE INDEX idx_expenses_search_trgm ON expenses
+                USING GIN (expense_search_text(description, category, subcategory) gin_trgm_ops);
+            END IF;
+        END;
+        $$;
+        """,
+        # The triggers went with the old table
+        """
+        CREATE TRIGGER expenses_rollup_insert AFTER INSERT ON expenses
+        REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION expenses_rollup_sync();
+        CREATE TRIGGER expenses_rollup_update AFTER UPDATE ON expenses
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION expenses_rollup_sync();
+        CREATE TRIGGER expenses_rollup_delete AFTER DELETE ON expenses
+        REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION expenses_rollup_sync();
+
+        CREATE TRIGGER expenses_category_insert AFTER INSERT ON expenses
+        REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION expenses_category_sync();
+        CREATE TRIGGER expenses_category_update AFTER UPDATE ON expenses
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION expenses_category_sync();
+        CREATE TRIGGER expenses_category_delete AFTER DELETE ON expenses
+        REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION expenses_category_sync();
+
+        ANALYZE expenses;
+        """,
+    ]),
+    (9, "recurring expenses", [
+        # next_date is the first occurrence not materialised yet, NULL once the rule has ended
+        """
+        CREATE TABLE IF NOT EXISTS recurring_expenses (
+            id SERIAL PRIMARY KEY,
+            user_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            frequency TEXT NOT NULL CHECK (frequency IN ('daily', 'weekly', 'monthly', 'yearly', 'cron')),
+            interval_count INTEGER NOT NULL DEFAULT 1 CHECK (interval_count > 0),
+            cron TEXT,
+            start_date DATE NOT NULL,
+            end_date DATE,
+            next_date DATE,
+            original_amount NUMERIC(10,2) NOT NULL CHECK (original_amount > 0),
+            currency CHAR(3) NOT NULL,
+            category TEXT NOT NULL,
+            subcategory TEXT,
+            description TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            CHECK ((frequency = 'cron') = (cron IS NOT NULL)),
+            CHECK (end_date IS NULL OR end_date >= start_date)
+        );
+        CREATE INDEX IF NOT EXISTS idx_recurring_expenses_due ON recurring_expenses (next_date) WHERE next_date IS NOT NULL;
+        """,
+        # An occurrence is one row per rule and date, materialising it again is a no-op. The unique key has to
+        # include the partition key anyway, expenses entered by hand have no recurring_id and never conflict.
+        """
+        ALTER TABLE expenses ADD COLUMN IF NOT EXISTS recurring_id INTEGER
+            CONSTRAINT expenses_recurring_id_fkey REFERENCES recurring_expenses(id) ON DELETE SET NULL;
+        ALTER TABLE expenses ADD CONSTRAINT expenses_recurring_occurrence_key UNIQUE (recurring_id, expense_date);
+        """,
+    ]),
+    (10, "multi user", [
+        # Users who sign in through the MCP auth provider are found by the subject of their access token
+        """
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS external_id TEXT UNIQUE;
+        ALTER TABLE users ALTER COLUMN email DROP NOT NULL;
+        """,
+        # Row level security keyed on app.user_id, which get_conn sets once per pooled connection to the user a tool
+        # acts for, or to 'all' for migrations, the recurring scheduler and the cli. Unset it matches nobody.
+        # Policies are run by the table owner too. Reads of expenses are left to the user_id condition every query
+        # has, a read policy would keep amount, keyset and search conditions out of the index (Postgres only pushes
+        # leakproof operators below a policy) while writes and the smaller per user tables are checked here.
+        # budget_spend has no user_id, it is reached through budgets.
+        """
+        CREATE OR REPLACE FUNCTION app_user_matches(row_user_id UUID) RETURNS BOOLEAN STABLE LANGUAGE sql AS $$
+            SELECT current_setting('app.user_id', true) = 'all'
+                OR row_user_id = NULLIF(NULLIF(current_setting('app.user_id', true), ''), 'all')::uuid
+        $$;
+
+        DO $$
+        DECLARE
+            table_name TEXT;
+        BEGIN
+            FOREACH table_name IN ARRAY ARRAY['expense_monthly_rollup', 'budgets', 'user_categories', 'recurring_expenses'] LOOP
+                EXECUTE format('ALTER TABLE %I ENABLE ROW LEVEL SECURITY, FORCE ROW LEVEL SECURITY', table_name);
+                EXECUTE format('CREATE POLICY %I ON %I USING (app_user_matches(user_id)) WITH CHECK (app_user_matches(user_id))',
+                               table_name || '_user_isolation', table_name);
+            END LOOP;
+        END $$;
+
+        ALTER TABLE expenses ENABLE ROW LEVEL SECURITY, FORCE ROW LEVEL SECURITY;
+        CREATE POLICY expenses_read ON expenses FOR SELECT USING (true);
+        CREATE POLICY expenses_user_insert ON expenses FOR INSERT WITH CHECK (app_user_matches(user_id));
+        CREATE POLICY expenses_user_update ON expenses FOR UPDATE USING (app_user_matches(user_id)) WITH CHECK (app_user_matches(user_id));
+        CREATE POLICY expenses_user_delete ON expenses FOR DELETE USING (app_user_matches(user_id));
+        """,
+    ]),
+    (11, "calendar periods", [
+        # Bounds of every year, quarter, month, fiscal year and fiscal quarter from 1970 to 2100, keyed by the period
+        # token the date filters take. Fiscal years are named by the calendar year they end in.
+        """
+        CREATE TABLE IF NOT EXISTS calendar_periods (
+            period TEXT PRIMARY KEY,
+            kind TEXT NOT NULL CHECK (kind IN ('year', 'quarter', 'month', 'fiscal_year', 'fiscal_quarter')),
+            start_date DATE NOT NULL,
+            end_date DATE NOT NULL,
+            CHECK (end_date >= start_date)
+        );
+
+        CREATE OR REPLACE FUNCTION fill_calendar_periods(fiscal_start_month INTEGER) RETURNS INTEGER LANGUAGE plpgsql AS $$
+        DECLARE
+            filled INTEGER;
+        BEGIN
+            DELETE FROM calendar_periods;
+            INSERT INTO calendar_periods (period, kind, start_date, end_date)
+            SELECT y::text, 'year', make_date(y, 1, 1), make_date(y, 12, 31)
+            FROM generate_series(1970, 2100) AS y
+            UNION ALL
+            SELECT to_char(m, 'YYYY-MM'), 'month', m::date, (m + interval '1 month' - interval '1 day')::date
+            FROM generate_series('1970-01-01'::timestamp, '2100-12-01', interval '1 month') AS m
+            UNION ALL
+            SELECT 'q' || extract(quarter FROM q) || '_' || extract(year FROM q), 'quarter', q::date, (q + interval '3 months' - interval '1 day')::date
+            FROM generate_series('1970-01-01'::timestamp, '2100-10-01', interval '3 months') AS q
+            UNION ALL
+            SELECT 'fy' || (y + (fiscal_start_month > 1)::int) || CASE WHEN n = 0 THEN '' ELSE '_q' || n END,
+                   CASE WHEN n = 0 THEN 'fiscal_year' ELSE 'fiscal_quarter' END,
+                   (make_date(y, fiscal_start_month, 1) + make_interval(months => 3 * greatest(n - 1, 0)))::date,
+                   (make_date(y, fiscal_start_month, 1) + make_interval(months => CASE WHEN n = 0 THEN 12 ELSE 3 * n END) - interval '1 day')::date
+            FROM generate_series(1969, 2100) AS y CROSS JOIN generate_series(0, 4) AS n;
+            GET DIAGNOSTICS filled = ROW_COUNT;
+            RETURN filled;
+        END;
+        $$;
+        """,
+        ensure_calendar,
+    ]),
+    (12, "search index by user", [
+        # Every search carries user_id, with btree_gin from contrib the GIN index holds it next to the words so a search
+        # reads only the postings of the user instead of those of every user's expenses. It replaces the plain index.
+        """
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'btree_gin') THEN
+                CREATE EXTENSION IF NOT EXISTS btree_gin;
+                CREATE INDEX IF NOT EXISTS idx_expenses_user_search_vector ON expenses USING GIN (user_id, search_vector);
+                DROP INDEX IF EXISTS idx_expenses_search_vector;
+            ELSE
+                RAISE NOTICE 'btree_gin is not available, expense search keeps the index without user_id';
+            END IF;
+        END;
+        $$;
+        """,
+    ]),
+    (13, "expense read isolation", [
+        # Reads of expenses get the same policy as the writes, a query that forgets its user_id condition sees only
+        # the rows of the connection's user. ensure_leakproof keeps the other conditions in the indexes below it.
+        """
+        DROP POLICY IF EXISTS expenses_read ON expenses;
+        CREATE POLICY expenses_user_read ON expenses FOR SELECT USING (app_user_matches(user_id));
+        """,
+        ensure_leakproof,
+    ]),
+    (14, "rollup skips unchanged buckets", [
+        # An update that leaves a bucket's count and totals as they were (a new description, a version bump) nets
+        # to zero there, HAVING keeps it from writing a rollup row version that changes nothing
+        """
+        CREATE OR REPLACE FUNCTION expenses_rollup_sync() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            -- Transition tables only exist for their own event, plpgsql plans a branch only when it runs
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO expense_monthly_rollup AS r (user_id, month, category, subcategory, currency, total_base, total_original, expense_count)
+                SELECT user_id, date_trunc('month', expense_date)::date, category, COALESCE(subcategory, ''), currency,
+                       SUM(base_amount), SUM(original_amount), COUNT(*)
+                FROM new_rows
+                GROUP BY 1, 2, 3, 4, 5
+                ON CONFLICT (user_id, month, category, subcategory, currency) DO UPDATE
+                SET total_base = r.total_base + EXCLUDED.total_base,
+                    total_original = r.total_original + EXCLUDED.total_original,
+                    expense_count = r.expense_count + EXCLUDED.expense_count;
+            ELSIF TG_OP = 'DELETE' THEN
+                UPDATE expense_monthly_rollup AS r
+                SET total_base = r.total_base - d.total_base,
+                    total_original = r.total_original - d.total_original,
+                    expense_count = r.expense_count - d.expense_count
+                FROM (
+                    SELECT user_id, date_trunc('month', expense_date)::date AS month, category, COALESCE(subcategory, '') AS subcategory, currency,
+                           SUM(base_amount) AS total_base, SUM(original_amount) AS total_original, COUNT(*) AS expense_count
+                    FROM old_rows
+                    GROUP BY 1, 2, 3, 4, 5
+                ) AS d
+                WHERE (r.user_id, r.month, r.category, r.subcategory, r.currency) = (d.user_id, d.month, d.category, d.subcategory, d.currency);
+            ELSE
+                -- Old and new versions can fall in the same bucket, so net them out before the upsert
+                INSERT INTO expense_monthly_rollup AS r (user_id, month, category, subcategory, currency, total_base, total_original, expense_count)
+                SELECT user_id, date_trunc('month', expense_date)::date, category, COALESCE(subcategory, ''), currency,
+                       SUM(sign * base_amount), SUM(sign * original_amount), SUM(sign)
+                FROM (
+                    SELECT 1 AS sign, user_id, expense_date, category, subcategory, currency, base_amount, original_amount FROM new_rows
+                    UNION ALL
+                    SELECT -1, user_id, expense_date, category, subcategory, currency, base_amount, original_amount FROM old_rows
+                ) AS changes
+                GROUP BY 1, 2, 3, 4, 5
+                HAVING SUM(sign) <> 0 OR SUM(sign * base_amount) <> 0 OR SUM(sign * original_amount) <> 0
+                ON CONFLICT (user_id, month, category, subcategory, currency) DO UPDATE
+                SET total_base = r.total_base + EXCLUDED.total_base,
+                    total_original = r.total_original + EXCLUDED.total_original,
+                    expense_count = r.expense_count + EXCLUDED.expense_count;
+            END IF;
+            RETURN NULL;
+        END;
+        $$;
+        """,
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+MIGRATION_LOCK_ID = 7_310_532 # Any constant, keeps concurrent server starts from migrating at the same time
+
+
+async def current_version(conn)-> int:
+    async with conn.cursor() as cur:
+        await cur.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+        if not (await cur.fetchone())[0]:
+            return 0
+        await cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        return (await cur.fetchone())[0]
+
+
+async def ensure_partitions(conn)-> int:
+    """
+    Create the expense partitions up to PARTITION_PREMAKE intervals ahead of today, and the partitions of backdated
+    rows that landed in the default partition since the last run. Returns how many were created.
+    """
+    async with conn.cursor() as cur:
+        await cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+        await cur.execute(
+            """
+            SELECT ensure_expense_partitions(LEAST(CURRENT_DATE, (SELECT MIN(expense_date) FROM expenses_default)), (CURRENT_DATE + make_interval(
+                months => CASE partition_interval WHEN 'month' THEN %s ELSE 0 END,
+                years => CASE partition_interval WHEN 'year' THEN %s ELSE 0 END))::date)
+            FROM partition_settings WHERE table_name = 'expenses'
+            """,
+            (PARTITION_PREMAKE, PARTITION_PREMAKE)
+        )
+        row = await cur.fetchone()
+    return row[0] if row else 0
+
+
+async def migrate()-> dict:
+    """
+    Bring the schema to LATEST_VERSION and make sure the coming expense partitions exist.
+    An up to date database costs two catalog reads, a partition, a calendar and a leakproof check, no DDL.
+    """
+    try:
+        async with get_conn(system=True) as conn:
+            version = await current_version(conn)
+            if version >= LATEST_VERSION:
+                await ensure_partitions(conn)
+                await ensure_calendar(conn)
+                await ensure_leakproof(conn)
+        if version >= LATEST_VERSION:
+            return {"from_version": version, "to_version": version, "applied": []}
+
+        applied = []
+        # All pending migrations run in one transaction, a failure leaves the schema at the old version
+        async with get_conn(system=True) as conn:
+            await conn.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+            version = await current_version(conn) # Another process may have migrated while we waited for the lock
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                );
+            """)
+            for number, name, statements in MIGRATIONS:
+                if number <= version:
+                    continue
+                for statement in statements:
+                    if callable(statement):
+                        await statement(conn)
+                    else:
+                        await conn.execute(statement)
+                await conn.execute("INSERT INTO schema_version (version, name) VALUES (%s, %s)", (number, name))
+                applied.append(number)
+            await ensure_partitions(conn)
+            await ensure_calendar(conn)
+    except Exception as e:
+        raise RuntimeError("Runtime Error on migrating schema") from e
+    if applied:
+        print(f"Schema migrated from version {version} to {LATEST_VERSION}", file=sys.stderr)
+    return {"from_version": version, "to_version": LATEST_VERSION, "applied": applied}
@@ -0,0 +1,68 @@
+import re
+from datetime import date,timedelta
+
+# Period tokens of the date filters. Relative tokens name the period around a given day, the calendar periods they map
+# to (years, quarters, months and fiscal years with their quarters) are looked up in the calendar_periods table while
+# days, weeks and last_n_days are bounded directly. Fiscal years are named by the calendar year they end in, so with
+# an April start fy2026 runs from 2025-04-01 to 2026-03-31.
+CALENDAR_PERIOD = re.compile(r"^(\d{4}|\d{4}-(0[1-9]|1[0-2])|q[1-4]_\d{4}|fy\d{4}(_q[1-4])?)$")
+LAST_N_DAYS = re.compile(r"^last_(?:n_days:(\d+)|(\d+)_days)$")
+PERIOD_TOKENS = [
+    "today", "yesterday", "this_week", "last_week", "this_month", "last_month", "this_quarter", "last_quarter",
+    "this_year", "last_year", "this_fy", "last_fy", "last_n_days:N", "2025", "2025-03", "q2_2026", "fy2025", "fy2025_q1",
+]
+
+
+def fiscal_year(day:date, start_month:int)-> int:
+    """Name of the fiscal year the day falls in."""
+    if start_month == 1:
+        return day.year
+    return day.year + 1 if day.month >= start_month else day.year
+
+
+def quarter_period(day:date)-> str:
+    return f"q{(day.month - 1) // 3 + 1}_{day.year}"
+
+
+def resolve_period(token:str, today:date, fiscal_start_month:int)-> str | tuple[date, date]:
+    """
+    The calendar period a token names, e.g. this_quarter -> 'q2_2026' on 2026-05-10, or the (start, end) bounds of
+    the tokens calendar_periods has no row for.
+    """
+    period = re.sub(r"\s+", "_", token.strip().lower()) # 'last month' works as well as 'last_month'
+    month_start = today.replace(day=1)
+    last_month = month_start - timedelta(days=1)
+    match period:
+        case "today":
+            return today, today
+        case "yesterday":
+            return today - timedelta(days=1), today - timedelta(days=1)
+        case "this_week" | "last_week":
+            # ISO weeks, Monday to Sunday
+            monday = today - timedelta(days=today.weekday()) - timedelta(weeks=period == "last_week")
+            return monday, monday + timedelta(days=6)
+        case "this_month":
+            return f"{today:%Y-%m}"
+        case "last_month":
+            return f"{last_month:%Y-%m}"
+        case "this_quarter":
+            return quarter_period(today)
+        case "last_quarter":
+            return quarter_period(month_start.replace(month=(today.month - 1) // 3 * 3 + 1) - timedelta(days=1))
+        case "this_year":
+            return str(today.year)
+        case "last_year":
+            return str(today.year - 1)
+        case "this_fy":
+            return f"fy{fiscal_year(today, fiscal_start_month)}"
+        case "last_fy":
+            return f"fy{fiscal_year(today, fiscal_start_month) - 1}"
+    days = LAST_N_DAYS.match(period)
+    if days:
+        count = int(days.group(1) or days.group(2))
+        if not 1 <= count <= 36600:
+            raise ValueError("last_n_days takes 1 to 36600 days")
+        return today - timedelta(days=count - 1), today
+    if CALENDAR_PERIOD.match(period):
+        return period
+    raise ValueError(f"Unknown period '{token}', use one of {', '.join(PERIOD_TOKENS)}")
@@ -0,0 +1,108 @@
+import calendar
+from functools import lru_cache
+from datetime import date,timedelta
+
+# Occurrence dates of recurring expense rules. Interval rules repeat every interval_count days, weeks, months or years
+# counted from start_date, so a rule starting on the 31st lands on the last day of shorter months and returns to the
+# 31st afterwards. Cron rules use the day of month, month and day of week fields of a crontab line.
+FREQUENCIES = ["daily", "weekly", "monthly", "yearly", "cron"]
+CRON_SCAN_DAYS = 8 * 366 # A cron rule without a match this far ahead has no further occurrences, e.g. "30 2 *"
+
+MONTH_NAMES = {name.lower(): number for number, name in enumerate(calendar.month_abbr) if name}
+DAY_NAMES = {"sun": 0, "mon": 1, "tue": 2, "wed": 3, "thu": 4, "fri": 5, "sat": 6}
+
+
+def add_months(day:date, months:int)-> date:
+    """day moved by months, clamped to the last day of the target month."""
+    month_index = day.year * 12 + day.month - 1 + months
+    year, month = divmod(month_index, 12)
+    return date(year, month + 1, min(day.day, calendar.monthrange(year, month + 1)[1]))
+
+
+def parse_cron_field(field:str, low:int, high:int, names:dict)-> set:
+    values = set()
+    for part in field.split(","):
+        part, _, step = part.partition("/")
+        if part == "*":
+            first, last = low, high
+        else:
+            first, _, last = part.partition("-")
+            first = names.get(first.lower(), first)
+            last = names.get(last.lower(), last) if last else first
+            try:
+                first, last = int(first), int(last)
+            except ValueError as e:
+                raise ValueError(f"Invalid cron field '{field}'") from e
+        try:
+            step = int(step) if step else 1
+        except ValueError as e:
+            raise ValueError(f"Invalid cron field '{field}'") from e
+        if not low <= first <= last <= high or step < 1:
+            raise ValueError(f"Cron field '{field}' must be within {low}-{high}")
+        values.update(range(first, last + 1, step))
+    return values
+
+
+@lru_cache(maxsize=256)
+def parse_cron(expression:str)-> tuple:
+    """
+    Parse the day fields of a cron expression, "day-of-month month day-of-week" or a full five field line whose
+    minute and hour are ignored since expenses are dated by day. Fields take *, lists, ranges, steps and names.
+    """
+    fields = expression.split()
+    if len(fields) == 5:
+        fields = fields[2:]
+    if len(fields) != 3:
+        raise ValueError("Cron expressions need the fields 'day-of-month month day-of-week', e.g. '1 * *' or '* * mon-fri'")
+    days = parse_cron_field(fields[0], 1, 31, {})
+    months = parse_cron_field(fields[1], 1, 12, MONTH_NAMES)
+    weekdays = {weekday % 7 for weekday in parse_cron_field(fields[2], 0, 7, DAY_NAMES)} # 0 and 7 are both Sunday
+    # Like cron, a day matches either field when both day of month and day of week are restricted. As in Vixie cron
+    # a field starting with * (e.g. */2) does not count as restricted, so "*/2 * mon" means every other day that is a Monday
+    return days, months, weekdays, not fields[0].startswith("*"), not fields[2].startswith("*")
+
+
+def cron_matches(spec:tuple, day:date)-> bool:
+    days, months, weekdays, days_restricted, weekdays_restricted = spec
+    if day.month not in months:
+        return False
+    day_match = day.day in days
+    weekday_match = (day.isoweekday() % 7) in weekdays
+    if days_restricted and weekdays_restricted:
+        return day_match or weekday_match
+    return day_match and weekday_match
+
+
+def next_occurrence(rule:dict, after:date)-> date | None:
+    """First occurrence of the rule on or after the given day, None when the rule has ended."""
+    start_date, end_date = rule["start_date"], rule["end_date"]
+    after = max(after, start_date)
+    frequency, step = rule["frequency"], rule["interval_count"]
+    if frequency == "cron":
+        spec = parse_cron(rule["cron"])
+        candidates = (after + timedelta(days=offset) for offset in range(CRON_SCAN_DAYS))
+        day = next((candidate for candidate in candidates if cron_matches(spec, candidate)), None)
+    elif frequency in ("daily", "weekly"):
+        step_days = step * (7 if frequency == "weekly" else 1)
+        day = start_date + timedelta(days=-(-(after - start_date).days // step_days) * step_days)
+    else:
+        step_months = step * (12 if frequency == "yearly" else 1)
+        # Start one step early, clamping can put the occurrence of a month before the day the month count suggests
+        n = max(0, ((after.year - start_date.year) * 12 + after.month - start_date.month) // step_months - 1)
+        day = add_months(start_date, n * step_months)
+        while day < after:
+            n += 1
+            day = add_months(start_date, n * step_months)
+    if day is None or (end_date is not None and day > end_date):
+        return None
+    return day
+
+
+def due_occurrences(rule:dict, until:date)-> tuple[list, date | None]:
+    """Occurrences from the rule's next_date up to and including until, and the next_date after them."""
+    days = []
+    day = rule["next_date"]
+    while day is not None and day <= until:
+        days.append(day)
+        day = next_occurrence(rule, day + timedelta(days=1))
+    return days, day
@@ -0,0 +1,64 @@
+"""
+Tests of the result cache and its metrics.
+
+    uv run python -m unittest discover tests
+"""
+import os,sys,unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "main"))
+
+from cache import ResultCache
+
+
+class ResultCacheTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_hit_after_load(self):
+        cache = ResultCache(max_entries=8, ttl=60)
+        loads = []
+
+        async def load():
+            loads.append(1)
+            return {"total": 1}
+
+        self.assertEqual(await cache.get_or_load("alice", "summary", "q", load), {"total": 1})
+        self.assertEqual(await cache.get_or_load("alice", "summary", "q", load), {"total": 1})
+        self.assertEqual(len(loads), 1)
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["hit_rate"]), (1, 1, 0.5))
+
+    def test_namespace_invalidation_frees_its_entries(self):
+        cache = ResultCache(max_entries=8, ttl=60)
+        for key in range(3):
+            cache.put("alice", "summary", key, key)
+        cache.put("alice", "expense", 1, "lunch")
+        cache.put("bob", "summary", 0, 0)
+        cache.invalidate("alice", "summary")
+        self.assertEqual(cache.stats()["size"], 2)
+        self.assertIsNone(cache.get("alice", "summary", 0))
+        self.assertEqual(cache.get("alice", "expense", 1), "lunch")
+        self.assertEqual(cache.get("bob", "summary", 0), 0)
+
+    def test_eviction_of_least_recently_used(self):
+        cache = ResultCache(max_entries=2, ttl=60)
+        cache.put("alice", "expense", 1, "a")
+        cache.put("alice", "expense", 2, "b")
+        cache.get("alice", "expense", 1)
+        cache.put("alice", "expense", 3, "c")
+        self.assertIsNone(cache.get("alice", "expense", 2))
+        self.assertEqual(cache.get("alice", "expense", 1), "a")
+        self.assertEqual(cache.stats()["evictions"], 1)
+        cache.invalidate("alice", "expense")
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_metrics_render_cache_counters(self):
+        from metrics import metrics
+        from cache import result_cache
+        result_cache.get("alice", "summary", "missing")
+        rendered = metrics.render()
+        self.assertIn('expense_result_cache_events_total{event="misses"}', rendered)
+        self.assertIn("# TYPE expense_result_cache_entries gauge", rendered)
+        self.assertIn("expense_result_cache_hit_ratio ", rendered)
+
+
+if __name__ == "__main__":
+    unittest.main()
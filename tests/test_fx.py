@@ -0,0 +1,123 @@
+"""
+Tests of the rates cache against a local stub of the rates API.
+
+    uv run python -m unittest discover tests
+"""
+import asyncio,json,os,sys,tempfile,threading,unittest
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler,ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "main"))
+
+from fx import RateCache
+
+USD_RATES = {"USD": 1, "INR": 80, "EUR": 0.8, "GBP": 0.5}
+
+
+class RatesStub:
+    """Serves /<base> like open.er-api.com from USD_RATES, counting the requests per base."""
+
+    def __init__(self):
+        stub = self
+        self.requests = {}
+        self.down = False
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                base = self.path.rsplit("/", 1)[-1]
+                stub.requests[base] = stub.requests.get(base, 0) + 1
+                if stub.down or base not in USD_RATES:
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                body = json.dumps({"result": "success", "base_code": base, "rates": {currency: rate / USD_RATES[base] for currency, rate in USD_RATES.items()}}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RateCacheTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.stub = RatesStub()
+        self.addCleanup(self.stub.close)
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = os.path.join(self.dir.name, "fx_rates_cache.json")
+
+    async def cache(self, ttl:float = 3600)-> RateCache:
+        cache = RateCache(api_url=self.stub.url, ttl=ttl, path=self.path)
+        self.addAsyncCleanup(cache.aclose)
+        return cache
+
+    async def test_hit_after_miss(self):
+        cache = await self.cache()
+        first = await cache.get_rates("USD")
+        second = await cache.get_rates("USD")
+        self.assertEqual(first, second)
+        self.assertEqual(first["INR"], 80)
+        self.assertEqual(self.stub.requests, {"USD": 1})
+        stats = cache.stats()
+        self.assertEqual((stats["misses"], stats["hits"], stats["fetches"]), (1, 1, 1))
+
+    async def test_refetch_after_ttl(self):
+        cache = await self.cache(ttl=0.05)
+        await cache.get_rates("USD")
+        await asyncio.sleep(0.1)
+        await cache.get_rates("USD")
+        self.assertEqual(self.stub.requests, {"USD": 2})
+        self.assertEqual(cache.stats()["misses"], 2)
+
+    async def test_stale_table_during_outage(self):
+        cache = await self.cache(ttl=0.05)
+        rates = await cache.get_rates("USD")
+        await asyncio.sleep(0.1)
+        self.stub.down = True
+        self.assertEqual(await cache.get_rates("USD"), rates)
+        stats = cache.stats()
+        self.assertEqual((stats["fetch_errors"], stats["stale_served"]), (1, 1))
+
+    async def test_outage_without_table(self):
+        cache = await self.cache()
+        self.stub.down = True
+        with self.assertRaises(RuntimeError):
+            await cache.get_rates("USD")
+
+    async def test_reload_from_cache_path(self):
+        rates = await (await self.cache()).get_rates("USD")
+        self.assertTrue(os.path.exists(self.path))
+        self.stub.down = True
+        restarted = await self.cache()
+        self.assertEqual(await restarted.get_rates("USD"), rates)
+        self.assertEqual(restarted.stats()["hits"], 1)
+        self.assertEqual(self.stub.requests, {"USD": 1})
+
+    async def test_many_currencies_share_one_table(self):
+        cache = await self.cache()
+        self.assertEqual(await cache.get_rate("INR", "INR"), Decimal(1))
+        self.assertEqual(await cache.get_rate("EUR", "INR"), Decimal(100))
+        self.assertEqual(await cache.get_rate("GBP", "INR"), Decimal(160))
+        self.assertEqual(await cache.get_rate("USD", "INR"), Decimal(80))
+        self.assertEqual(self.stub.requests, {"INR": 1})
+
+    async def test_fresh_source_table_is_used(self):
+        cache = await self.cache()
+        await cache.get_rates("EUR")
+        self.assertEqual(await cache.get_rate("EUR", "GBP"), Decimal("0.625"))
+        self.assertEqual(self.stub.requests, {"EUR": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+"""
+Tests of the occurrence dates of recurring expense rules.
+
+    uv run python -m unittest discover tests
+"""
+import os,sys,unittest
+from datetime import date
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "main"))
+
+from recurring import cron_matches,next_occurrence,parse_cron
+
+
+def cron_rule(cron:str, start_date:date)-> dict:
+    return {"frequency": "cron", "cron": cron, "interval_count": 1, "start_date": start_date, "end_date": None}
+
+
+class CronTest(unittest.TestCase):
+
+    def matching_days(self, cron:str, first:date, last:date)-> list:
+        spec = parse_cron(cron)
+        return [date.fromordinal(n) for n in range(first.toordinal(), last.toordinal() + 1) if cron_matches(spec, date.fromordinal(n))]
+
+    def test_day_of_month_or_weekday_when_both_restricted(self):
+        # The 1st of March 2026 is a Sunday, Mondays are the 2nd, 9th, 16th, 23rd and 30th
+        days = self.matching_days("15 * mon", date(2026, 3, 1), date(2026, 3, 31))
+        self.assertEqual([day.day for day in days], [2, 9, 15, 16, 23, 30])
+
+    def test_stepped_star_is_not_a_restriction(self):
+        # Vixie cron ANDs the fields when one of them starts with *, */2 only keeps the odd days
+        days = self.matching_days("*/2 * mon", date(2026, 3, 1), date(2026, 3, 31))
+        self.assertEqual([day.day for day in days], [9, 23])
+        days = self.matching_days("1-7 * */3", date(2026, 3, 1), date(2026, 3, 31))
+        self.assertEqual([day.day for day in days], [1, 4, 7])
+
+    def test_five_field_line_ignores_minute_and_hour(self):
+        self.assertEqual(parse_cron("30 2 1 * *"), parse_cron("1 * *"))
+
+    def test_next_occurrence_of_weekdays(self):
+        rule = cron_rule("* * mon-fri", date(2026, 1, 1))
+        self.assertEqual(next_occurrence(rule, date(2026, 3, 7)), date(2026, 3, 9))
+
+    def test_invalid_field(self):
+        with self.assertRaises(ValueError):
+            parse_cron("32 * *")
+        with self.assertRaises(ValueError):
+            parse_cron("* *")
+
+
+if __name__ == "__main__":
+    unittest.main()